@@ -23,17 +23,37 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 Main repository is located at: https://github.com/JohnDN90/YiDashCamConcatenate
 """
 
-from time import sleep
+from time import sleep, time
 
 import os
-from subprocess import check_output, call
+import io
+from subprocess import check_output, call, Popen, PIPE, CalledProcessError
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from threading import Lock, Thread, BoundedSemaphore, Condition, Event
+from functools import partial
 from pytz import timezone, utc
 from datetime import datetime
-from shutil import copyfile
+from shutil import rmtree
+from glob import glob
 import sys
 import shlex
+import json
+import hashlib
+import re
+import struct
+import random
+import math
+import ast
+import argparse
+import tempfile
 from warnings import warn
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 if os.name == "nt":
     import pywintypes, win32file, win32con
     def changeFileCreationTime(fname, newtime):
@@ -51,55 +71,204 @@ else:
         pass
 
 
-def callFFmpeg(cmd):
+promptLock = Lock()
+progressInterval = 10.0
+encodeSlots = None
+encodeSlotsLock = Lock()
+
+def getEncodeSlots():
+    """
+    Returns the semaphore limiting the number of concurrently running FFmpeg
+    encodes to maxParallelJobs across all trips and chunks.
+    """
+    global encodeSlots
+    with encodeSlotsLock:
+        if encodeSlots is None:
+            encodeSlots = BoundedSemaphore(max(1, int(maxParallelJobs)))
+    return encodeSlots
+
+# Set when the run is interrupted, so the jobs still running in other threads
+# do not start any more FFmpeg processes
+stopEvent = Event()
+
+class RunInterrupted(Exception):
     """
-    A wrapper around subprocess.call which handles the case of when user
-    specifies not to overwrite an existing file.
+    Raised by the jobs of a run after it was interrupted, see stopEvent.
     """
-    ignoreRetCode = False
+    pass
 
+def callFFmpeg(cmd, stats=None, duration=None):
+    """
+    Runs the FFmpeg command cmd, a list or a string, once one of the
+    maxParallelJobs encode slots is free (see getEncodeSlots) and returns its
+    return code. FFmpeg is run with -nostdin so parallel jobs do not read the
+    answers to the overwrite prompt of shouldWriteOutput. Raises
+    RunInterrupted if the run was interrupted while waiting for a slot.
+
+    If a dictionary is passed as stats, FFmpeg is run with runFFmpeg, which
+    reports the progress of the job and fills stats with its statistics.
+    duration is the expected duration of the output in seconds, used to
+    estimate the remaining time.
+    """
     # If command is a string, split it into a list
     if isinstance(cmd, str):
         cmd = shlex.split(cmd)
+    cmd = cmd[:1] + ['-nostdin'] + cmd[1:]
 
-    # Handle the case for when a file exists
-    if (cmd[-1].lower()=="-n"):
-        if os.path.isfile(cmd[-2]):
-            ignoreRetCode = True
+    # Call FFmpeg
+    with getEncodeSlots():
+        if stopEvent.is_set():
+            raise RunInterrupted("The run was interrupted.")
+        if stats is None:
+            return call(cmd)
+        return runFFmpeg(cmd, stats, duration)
+
+
+def formatDuration(seconds):
+    seconds = int(max(seconds, 0))
+    return "%i:%02i:%02i" % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+
+def runFFmpeg(cmd, stats, duration=None):
+    """
+    Runs FFmpeg with "-progress pipe:1" and prints the frame rate, speed,
+    bitrate and estimated remaining time of the job every progressInterval
+    seconds. FFmpeg only logs errors, which are collected instead of printed.
+
+    Parameters
+    ----------
+    cmd :   list of str
+        FFmpeg command, the last argument being the output path optionally
+        followed by "-y" or "-n".
+    stats   :   dict
+        Filled with the last progress report ("progress"), the logged errors
+        ("errors") and the run time of FFmpeg in seconds ("wallSeconds").
+    duration    :   float, optional
+        Expected duration of the output in seconds.
+
+    Returns
+    -------
+    retCode :   int
+        Return code of FFmpeg.
+    """
+    if cmd[-1].lower() in ("-y", "-n"):
+        label = os.path.basename(cmd[-2])
     else:
-        if os.path.isfile(cmd[-1]):
-            ans = raw_input("File '%s' already exists. Overwrite ? [y/N] "%cmd[-1]) or "N"
-            if (ans.lower() == "y") or (ans.lower() == "yes"):
-                overwrite = "-y"
-            else:
-                overwrite = "-n"
-                ignoreRetCode = True
-            cmd.append(overwrite)
+        label = os.path.basename(cmd[-1])
+    cmd = cmd[:1] + ['-v', 'error', '-nostats', '-progress', 'pipe:1'] + cmd[1:]
+
+    start = time()
+    proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    # Read the errors on a separate thread so neither pipe can fill up
+    errors = []
+    errThread = Thread(target=lambda: errors.extend(proc.stderr.readlines()))
+    errThread.start()
+
+    block = {}
+    lastPrint = start
+    stats["progress"] = {}
+    for line in iter(proc.stdout.readline, b''):
+        line = line.decode("utf-8", "replace").strip()
+        if "=" not in line:
+            continue
+        key, value = line.split("=", 1)
+        block[key.strip()] = value.strip()
+        if key == "progress":
+            # A complete progress report has been read
+            stats["progress"] = block
+            block = {}
+            if time() - lastPrint >= progressInterval:
+                lastPrint = time()
+                print("[%s] %s" % (label, formatProgress(stats["progress"], duration)))
+    proc.wait()
+    errThread.join()
+
+    stats["errors"] = b"".join(errors).decode("utf-8", "replace").strip()
+    stats["wallSeconds"] = time() - start
+    return proc.returncode
+
+
+def getProgressTime(progress):
+    """
+    Returns the output time in seconds of an FFmpeg progress report.
+    """
+    outTime = progress.get("out_time_us", progress.get("out_time_ms", "0"))
+    try:
+        return float(outTime) / 1e6
+    except ValueError:
+        return 0.0
 
-    # Call FFmpeg
-    encodeRetCode = call(cmd)
 
-    # If overwriting was not specified, set error code to -1 to indicate user
-    # specified not to overwrite existing file.
-    if (encodeRetCode) and (ignoreRetCode):
-        encodeRetCode = -1
+def formatProgress(progress, duration=None):
+    """
+    Formats an FFmpeg progress report as a single line of text.
+    """
+    outTime = getProgressTime(progress)
+    text = "%s, %s fps, %s, %s" % (formatDuration(outTime),
+                                   progress.get("fps", "N/A"),
+                                   progress.get("speed", "N/A").strip(),
+                                   progress.get("bitrate", "N/A").strip())
+    speed = progress.get("speed", "").strip().rstrip("x")
+    try:
+        speed = float(speed)
+    except ValueError:
+        speed = 0.0
+    if duration and speed > 0:
+        text += ", ETA %s" % formatDuration((duration - outTime) / speed)
+    return text
+
 
-    return encodeRetCode
 
+statCache = {}
+statCacheLock = Lock()
 
+def getStat(filePath):
+    """
+    Returns the os.stat result of a source file, which is only read once per
+    run since the files on the SD card do not change while they are archived.
+    """
+    key = os.path.abspath(filePath)
+    with statCacheLock:
+        st = statCache.get(key)
+    if st is None:
+        st = os.stat(filePath)
+        with statCacheLock:
+            statCache[key] = st
+    return st
+
+# pytz timezone of cameraTimezone, resolved by loadSettings, or None if the
+# clock of the camera is in the timezone of this PC
+cameraTz = None
+utcTimes = {}
 
 def getUTCmtime(filePath):
-    mt = os.path.getmtime(filePath)
-    local = timezone("America/New_York")
-    naive = datetime.fromtimestamp(mt)
-    local_dt = local.localize(naive, is_dst=None)
-    utc_dt = local_dt.astimezone(utc)
-    return utc_dt.strftime("%Y-%m-%d %H:%M:%S")
-
-def getLocalmtime(filePath):
-    mt = os.path.getmtime(filePath)
-    naive = datetime.fromtimestamp(mt)
-    return naive.strftime("%Y-%m-%d %H:%M:%S")
+    """
+    Returns the modification time of a source file in UTC, formatted for the
+    creation_time metadata of FFmpeg. The camera stores its local time on the
+    SD card, which is interpreted in cameraTimezone, or in the timezone of
+    this PC if cameraTimezone is None.
+    """
+    mt = getStat(filePath).st_mtime
+    text = utcTimes.get(mt)
+    if text is None:
+        if cameraTz is None:
+            utc_dt = datetime.fromtimestamp(mt, utc)
+        else:
+            naive = datetime.fromtimestamp(mt)
+            local_dt = cameraTz.localize(naive)
+            utc_dt = local_dt.astimezone(utc)
+        text = utc_dt.strftime("%Y-%m-%dT%H:%M:%SZ")
+        utcTimes[mt] = text
+    return text
+
+def copyTimes(src, dst):
+    """
+    Sets the access, modification and creation times of dst to those of the
+    source file src.
+    """
+    st = getStat(src)
+    os.utime(dst, (st.st_atime, st.st_mtime))
+    changeFileCreationTime(dst, st.st_ctime)
 
 def pyempty(n):
     """
@@ -125,7 +294,7 @@ def pyconcatenate(vlist):
     """
     list = []
     for v in vlist:
-        list = list + v
+        list.extend(v)
     return list
 
 def pyargsort(vlist):
@@ -139,149 +308,1775 @@ diff = pydiff
 where = pywhere
 concatenate = pyconcatenate
 
-errorVideos = []
+def parseProgress(text):
+    """
+    Parses the key=value output of FFmpeg's -progress option and returns the
+    values of the last progress report as a dictionary.
+    """
+    progress = {}
+    for line in text.splitlines():
+        if "=" in line:
+            key, value = line.split("=", 1)
+            progress[key.strip()] = value.strip()
+    return progress
+
 
-def checkVideoFile(filePath):
+def getExpectedStats(vidList):
+    """
+    Returns the expected duration and number of video frames of an output
+    file made from the video segments in vidList, and the times at which the
+    segments are joined. The frame count is None if it is unknown for any
+    segment or a video filter may change it.
+    """
+    infos = [getProbe(vid) for vid in vidList]
+    expected = {"duration": sum(info["duration"] for info in infos),
+                "frames": None, "segments": len(vidList), "boundaries": []}
+    # Times at which the segments were joined
+    t = 0.0
+    for info in infos[:-1]:
+        t += info["duration"] or 0.0
+        expected["boundaries"].append(t)
+    if videoFilters is None and all(info["nbFrames"] for info in infos):
+        expected["frames"] = sum(info["nbFrames"] for info in infos)
+    return expected
+
+
+def isDurationValid(duration, expected):
     """
-    Checks the integrity of a video file. First performs a quick test on only
-    the metadata using ffprobe. If the quick test passes, performs an
-    intermediate test on only the audio stream using "ffmpeg -v error". If, the
-    intermediate test passes, a final extensive test is performed on both the
-    video and audio streams using "ffmpeg -v error".
+    Compares a duration in seconds to the expected duration. Each segment
+    boundary may add or drop up to a frame of video or audio, so the tolerance
+    grows with the number of segments.
+    """
+    if expected["duration"] is None:
+        return True
+    tolerance = 1.0 + 0.1 * expected["segments"]
+    return abs(duration - expected["duration"]) <= tolerance
+
+
+def isFrameCountValid(frames, expected):
+    """
+    Compares a number of video frames to the expected number of frames,
+    allowing two frames of difference per segment boundary.
+    """
+    if expected["frames"] is None:
+        return True
+    return abs(frames - expected["frames"]) <= 2 * expected["segments"]
+
+
+def checkVideoFile(filePath, expected=None, level=None):
+    """
+    Checks the integrity of a video file. The metadata is always checked with
+    ffprobe and the duration is compared to the expected duration. Depending on
+    the level, all packets are then read ("packet") or all streams are decoded
+    once ("decode") and the number of video frames is compared to the expected
+    number of frames.
 
     Parameters
     ----------
     filePath    :   str
         Path to the video file to be checked for errors.
+    expected    :   dict, optional
+        Expected "duration", number of "frames" and number of source
+        "segments" as returned by getExpectedStats. Comparisons are skipped
+        when not given.
+    level   :   str, optional
+        One of "probe", "packet", "sampled" or "decode". Defaults to
+        verifyLevel.
 
     Returns
     -------
     retCode :   int
         Return code, 0 if no errors detected, otherwise nonzero.
-
-    Notes
-    -----
-    The final test on both audio and video streams does everything the first two
-    tests do. The first two tests run very fast however and are included so the
-    code runs faster in the case of a corrupted video file. In the case of a
-    valid file, the increase in runtime is negligible.
     """
-    print("\nChecking integrity of transcoded video file...")
+    if level is None:
+        level = verifyLevel
+    if level == "inline":
+        # Outputs verified inline did not record their statistics
+        level = "probe"
+    if expected is None:
+        expected = {"duration": None, "frames": None, "segments": 1}
+    print("\nChecking integrity of %s (%s)..." % (filePath, level))
+
     # Perform fast basic test (ffprobe) first
-    cmd = 'ffprobe -hide_banner -i "%s"'%filePath
-    retCode = call(shlex.split(cmd))
-    if retCode:
-        print("Test 1 of 3: Failed\nExiting...\n")
-        return retCode
-    # If the basic test passed, perform the longer tests (ffmpeg -v error)
+    try:
+        info = probeVideo(filePath)
+    except CalledProcessError as e:
+        print("Metadata check: Failed\n")
+        return e.returncode or 1
+    if not isDurationValid(info["duration"], expected):
+        print("Metadata check: Failed, duration is %.2f s, expected %.2f s\n"
+              % (info["duration"], expected["duration"]))
+        return 1
+    print("Metadata check: Passed")
+    if level == "probe":
+        return 0
+    if level == "sampled":
+        return checkSampled(filePath, info, expected)
+
+    if level == "packet":
+        # Read every packet without decoding
+        cmd = ['ffprobe', '-v', 'error', '-count_packets', '-select_streams',
+               'v:0', '-show_entries', 'stream=nb_read_packets', '-of',
+               'csv=p=0', filePath]
+    elif level == "decode":
+        # Decode all streams once
+        cmd = [ffmpegPath, '-hide_banner', '-nostdin', '-v', 'error',
+               '-nostats', '-progress', 'pipe:1', '-i', filePath, '-map', '0',
+               '-f', 'null', '-']
     else:
-        print("Test 1 of 3: Passed")
-        # Perform an intermediate test on only the audio stream
-        cmd = 'ffmpeg -hide_banner -v error -i "%s" -map 0:1 -f null -' % filePath
-        retCode = call(shlex.split(cmd))
-        if retCode:
-            print("Test 2 of 3: Failed\nExiting...\n")
-            return retCode
-        else:
-            print("Test 2 of 3: Passed")
-            # Performn an extensive test on both video and audio streams
-            cmd = 'ffmpeg -hide_banner -v error -i "%s" -f null -'%filePath
-            retCode = call(shlex.split(cmd))
-            if retCode:
-                print("Test 3 of 3: Failed\nExiting...\n")
-            else:
-                print("Test 3 of 3: Passed\nExiting...\n")
-    return retCode
+        raise ValueError("User-specified verifyLevel, %s, is not valid." % level)
+    proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    out, err = proc.communicate()
+    out = out.decode("utf-8", "replace")
+    err = err.decode("utf-8", "replace").strip()
+    if proc.returncode or err:
+        print("Stream check: Failed\n%s\n" % err)
+        return proc.returncode or 1
+
+    if level == "packet":
+        frames = int(out.strip() or 0)
+    else:
+        frames = int(parseProgress(out).get("frame", 0))
+    if not isFrameCountValid(frames, expected):
+        print("Stream check: Failed, %i video frames, expected %i\n"
+              % (frames, expected["frames"]))
+        return 1
+    print("Stream check: Passed\n")
+    return 0
+
+
+def readTopLevelBoxes(filePath):
+    """
+    Returns the types of the top level boxes of an MP4 file, raising
+    ValueError if a box extends past the end of the file.
+    """
+    boxes = []
+    fileSize = os.path.getsize(filePath)
+    with open(filePath, 'rb') as f:
+        offset = 0
+        while offset < fileSize:
+            f.seek(offset)
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError("truncated box header at byte %i" % offset)
+            boxSize, boxType = struct.unpack(">I4s", header)
+            if boxSize == 1:
+                boxSize = struct.unpack(">Q", f.read(8))[0]
+            elif boxSize == 0:
+                # The last box extends to the end of the file
+                boxSize = fileSize - offset
+            boxType = boxType.decode("latin-1")
+            if boxSize < 8 or offset + boxSize > fileSize:
+                raise ValueError("'%s' box at byte %i extends past the end of the file"
+                                 % (boxType, offset))
+            boxes.append(boxType)
+            offset += boxSize
+    return boxes
+
+# Length in seconds of each piece decoded by checkSampled, about one GOP of
+# the camera
+verifySampleSeconds = 2
+
+def checkSampled(filePath, info, expected):
+    """
+    Checks a stream copied output file without decoding all of it. The box
+    structure of the file must be complete with the moov box before the mdat
+    box, the number of video packets must match the number of frames of the
+    video segments, and verifySamples randomly chosen GOPs, half of them at
+    the joins between the segments, are decoded. See checkVideoFile for the
+    parameters and return value.
+    """
+    try:
+        boxes = readTopLevelBoxes(filePath)
+        if boxes[:1] != ["ftyp"] or "moov" not in boxes or "mdat" not in boxes:
+            raise ValueError("boxes are %s" % boxes)
+        if boxes.index("moov") > boxes.index("mdat"):
+            raise ValueError("the moov box is not before the mdat box")
+    except (IOError, ValueError) as e:
+        print("Structure check: Failed, %s\n" % e)
+        return 1
+    print("Structure check: Passed")
+
+    cmd = ['ffprobe', '-v', 'error', '-count_packets', '-select_streams',
+           'v:0', '-show_entries', 'stream=nb_read_packets', '-of',
+           'csv=p=0', filePath]
+    proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    out, err = proc.communicate()
+    err = err.decode("utf-8", "replace").strip()
+    if proc.returncode or err:
+        print("Packet check: Failed\n%s\n" % err)
+        return proc.returncode or 1
+    packets = int(out.decode("utf-8", "replace").strip() or 0)
+    if not isFrameCountValid(packets, expected):
+        print("Packet check: Failed, %i video packets, expected %i\n"
+              % (packets, expected["frames"]))
+        return 1
+    print("Packet check: Passed")
+
+    # Decode a GOP at each sampled time, FFmpeg seeks to the keyframe before it
+    duration = info["duration"] or 0.0
+    boundaries = expected.get("boundaries", [])
+    nSamples = max(1, int(verifySamples))
+    times = random.sample(boundaries, min(len(boundaries), nSamples // 2))
+    times += [random.uniform(0.0, duration) for i in range(nSamples - len(times))]
+    cmd = [ffmpegPath, '-hide_banner', '-nostdin', '-v', 'error', '-nostats']
+    for t in sorted(times):
+        cmd += ['-ss', "%.3f" % max(t - 0.5, 0.0), '-t', str(verifySampleSeconds), '-i', filePath]
+    for i in range(len(times)):
+        cmd += ['-map', '%i' % i]
+    cmd += ['-f', 'null', '-']
+    proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    out, err = proc.communicate()
+    err = err.decode("utf-8", "replace").strip()
+    if proc.returncode or err:
+        print("Stream check: Failed\n%s\n" % err)
+        return proc.returncode or 1
+    print("Stream check: Passed (%i sampled GOPs)\n" % len(times))
+    return 0
+
+
+def checkEncodeStats(filePath, stats, expected):
+    """
+    Checks the integrity of a video file from the statistics reported by the
+    FFmpeg process which created it (see callFFmpeg), without reading the file.
+
+    Returns
+    -------
+    retCode :   int
+        Return code, 0 if no errors detected, otherwise nonzero.
+    """
+    print("\nChecking integrity of %s (inline)..." % filePath)
+    if stats["errors"]:
+        print("Encode check: Failed\n%s\n" % stats["errors"])
+        return 1
+    progress = stats["progress"]
+    duration = getProgressTime(progress)
+    frames = int(progress.get("frame", 0))
+    if not isDurationValid(duration, expected):
+        print("Encode check: Failed, duration is %.2f s, expected %.2f s\n"
+              % (duration, expected["duration"]))
+        return 1
+    if not isFrameCountValid(frames, expected):
+        print("Encode check: Failed, %i video frames, expected %i\n"
+              % (frames, expected["frames"]))
+        return 1
+    print("Encode check: Passed\n")
+    return 0
 
 
 def getIndNewVids(stimes, maxDiff):
+    """
+    Returns the indices of the segments which start a new trip, given the
+    sorted start times of the segments in seconds. Uses NumPy if available.
+    """
+    if numpy is not None:
+        gaps = numpy.diff(numpy.asarray(stimes, dtype=float)) - 60.0
+        return [0] + (numpy.nonzero(gaps > maxDiff)[0] + 1).tolist()
     logic = [(i-60.0)>maxDiff for i in diff(stimes)]
     ind_newVids = [i+1 for i in where(logic)[0]]
     ind_newVids = concatenate(([0], ind_newVids))
     return ind_newVids
 
+# Matches the date and time in Yi Dash Cam file names, for example
+# 2019_0115_123456.MP4 or 2019_01_15_123456.MP4
+segmentNamePattern = re.compile(r"(\d{4}_?\d{2}_?\d{2})_(\d{2})(\d{2})(\d{2})")
+
+def parseSegmentName(filename):
+    """
+    Parses the date and time from the name of a video segment.
+
+    Parameters
+    ----------
+    filename    :   str
+        Path to the video segment.
+
+    Returns
+    -------
+    segment :   tuple or None
+        (date, time, seconds) where date and time are the parts of the name
+        used for the output name, e.g. "2019_0115" and "123456", and seconds
+        is the start of the segment in seconds since 0001-01-01, so that
+        differences are valid across midnight. None if the name does not
+        contain a date and time.
+    """
+    entry = cardIndex.get(filename)
+    if entry is not None:
+        if entry.seconds is None:
+            return None
+        return entry.date, entry.time, entry.seconds
+    return parseName(os.path.basename(filename))
+
+def parseName(name):
+    """
+    Parses the (date, time, seconds) tuple of parseSegmentName from the base
+    name of a file, or returns None if it contains no date and time.
+    """
+    m = segmentNamePattern.search(name)
+    if m is None:
+        return None
+    date = m.group(1)
+    digits = date.replace("_", "")
+    try:
+        day = datetime(int(digits[:4]), int(digits[4:6]), int(digits[6:8])).toordinal()
+    except ValueError:
+        # Looks like a date, but is not one, e.g. 1234_5678_123456.MP4
+        return None
+    seconds = (day * 86400 + int(m.group(2)) * 3600 + int(m.group(3)) * 60 +
+               int(m.group(4)))
+    return date, m.group(2) + m.group(3) + m.group(4), seconds
+
 def getTitleDate(filename):
-   name = os.path.basename(filename)
-   return "_".join(name.split("_")[:3])
+    segment = parseSegmentName(filename)
+    if segment is None:
+        name = os.path.basename(filename)
+        return "_".join(name.split("_")[:3])
+    return segment[0]
 
 def getTitleTime(filename):
-    name = os.path.basename(filename)
-    return (name.split("_")[-1])[:-4]
+    segment = parseSegmentName(filename)
+    if segment is None:
+        name = os.path.basename(filename)
+        return (name.split("_")[-1])[:-4]
+    return segment[1]
+
+class CardFile(object):
+    """
+    Entry of the card index: path, name, size and modification time of a file
+    on the SD card and the date, time and seconds parsed from its name by
+    parseSegmentName, which are None if the name has no date and time.
+    """
+    __slots__ = ("path", "name", "size", "mtime", "date", "time", "seconds")
+
+    def __init__(self, path, name, st):
+        self.path = path
+        self.name = name
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        segment = parseName(name)
+        if segment is None:
+            self.date = self.time = self.seconds = None
+        else:
+            self.date, self.time, self.seconds = segment
+
+cardIndex = {}
+cardIndexLock = Lock()
+
+def scanDirectory(d):
+    """
+    Lists the files in a directory of the SD card in a single pass and adds
+    them to the card index, so the names are only parsed once and the sizes
+    and modification times are served by getStat without another stat call.
+
+    Returns
+    -------
+    entries :   list of CardFile
+        The files in the directory, sorted by name. Empty if the directory
+        does not exist, as cards may lack the EMR or Photo directory.
+    """
+    entries = []
+    if not os.path.isdir(d):
+        return []
+    if hasattr(os, "scandir"):
+        for entry in os.scandir(d):
+            if entry.is_file():
+                entries.append((entry.name, entry.path, entry.stat()))
+    else:
+        for name in os.listdir(d):
+            path = os.path.join(d, name)
+            if os.path.isfile(path):
+                entries.append((name, path, os.stat(path)))
+    entries.sort()
+    files = [CardFile(path, name, st) for name, path, st in entries]
+    with cardIndexLock:
+        for f in files:
+            cardIndex[f.path] = f
+    with statCacheLock:
+        for name, path, st in entries:
+            statCache[os.path.abspath(path)] = st
+    return files
 
 def abslistdir(d):
-    return [os.path.join(d,f) for f in os.listdir(d)]
+    return [f.path for f in scanDirectory(d)]
+
+def listSegments(d):
+    """
+    Returns the paths to the video segments in a directory of the SD card,
+    sorted by name. Files with "_s" in their name are skipped.
+    """
+    return [f.path for f in scanDirectory(d)
+            if f.name.lower().endswith(".mp4") and "_s" not in f.name]
+
+probeCache = {}
+probeCacheLock = Lock()
+probeCacheFileLock = Lock()
+probeCacheName = ".ydcc_probe_cache.json"
+
+def getFileKey(filePath):
+    """
+    Returns the key identifying a file in the probe cache, composed of the
+    absolute path, size and modification time of the file.
+    """
+    st = getStat(filePath)
+    return "%s|%i|%.6f" % (os.path.abspath(filePath), st.st_size, st.st_mtime)
+
+def loadProbeCache():
+    """
+    Loads the probe results stored in outputDir by previous runs.
+    """
+    cachePath = os.path.join(outputDir, probeCacheName)
+    try:
+        with open(cachePath, 'r') as cacheFile:
+            cache = json.load(cacheFile)
+    except (IOError, OSError, ValueError):
+        return
+    with probeCacheLock:
+        probeCache.update(cache)
+
+def saveProbeCache():
+    """
+    Writes the probe results to outputDir so later runs do not probe the same
+    files again.
+    """
+    cachePath = os.path.join(outputDir, probeCacheName)
+    tmpPath = cachePath + ".tmp"
+    # Concurrent trips may save the cache at the same time
+    with probeCacheFileLock:
+        with probeCacheLock:
+            data = json.dumps(probeCache)
+        with open(tmpPath, 'w') as cacheFile:
+            cacheFile.write(data)
+        replaceFile(tmpPath, cachePath)
+
+def probeVideo(filePath):
+    """
+    Retrieves the stream information of a video file with a single ffprobe
+    call.
+
+    Parameters
+    ----------
+    filePath    :   str
+        Path to the video file to be probed.
+
+    Returns
+    -------
+    info    :   dict
+        Dictionary with the keys "width", "height", "videoCodec",
+        "audioCodec", "duration", "frameRate", "startTime" and "nbFrames".
+        Values which could not be determined are None.
+    """
+    cmd = ['ffprobe', '-v', 'error', '-of', 'json',
+           '-show_entries',
+           'format=duration,start_time:stream=codec_type,codec_name,width,'
+           'height,r_frame_rate,nb_frames,start_time',
+           filePath]
+    data = json.loads(check_output(cmd).decode("utf-8"))
+    fmt = data.get("format", {})
+    info = {"width": None, "height": None, "videoCodec": None,
+            "audioCodec": None, "frameRate": None, "nbFrames": None,
+            "duration": float(fmt.get("duration", 0.0)),
+            "startTime": float(fmt.get("start_time", 0.0))}
+    for stream in data.get("streams", []):
+        if stream.get("codec_type") == "video" and info["videoCodec"] is None:
+            info["videoCodec"] = stream.get("codec_name")
+            info["width"] = stream.get("width")
+            info["height"] = stream.get("height")
+            num, den = stream.get("r_frame_rate", "0/1").split("/")
+            if float(den):
+                info["frameRate"] = float(num) / float(den)
+            if stream.get("nb_frames"):
+                info["nbFrames"] = int(stream["nb_frames"])
+        elif stream.get("codec_type") == "audio" and info["audioCodec"] is None:
+            info["audioCodec"] = stream.get("codec_name")
+    return info
+
+def getProbe(filePath):
+    """
+    Returns the cached stream information of a video file, probing the file if
+    it is not in the cache yet. If the file cannot be read, such as a segment
+    truncated by a power cut, the information only has the key "error".
+    """
+    key = getFileKey(filePath)
+    with probeCacheLock:
+        info = probeCache.get(key)
+    if info is None:
+        try:
+            info = probeVideo(filePath)
+        except CalledProcessError as e:
+            info = {"error": "ffprobe returned a %s error code" % e.returncode}
+        except ValueError as e:
+            info = {"error": str(e)}
+        with probeCacheLock:
+            probeCache[key] = info
+    return info
+
+def probeVideos(vlist):
+    """
+    Probes all video files which are not in the probe cache yet. The files are
+    probed concurrently since ffprobe only accepts a single input, and the
+    cache is written back to outputDir afterwards.
+    """
+    with probeCacheLock:
+        missing = [vid for vid in vlist if getFileKey(vid) not in probeCache]
+    if missing:
+        pool = ThreadPool(4)
+        try:
+            pool.map(getProbe, missing, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        saveProbeCache()
+
+def dropUnreadable(vlist):
+    """
+    Returns vlist without the video segments which could not be probed,
+    according to the probe cache, with a warning for each of them.
+    """
+    readable = []
+    for vid in vlist:
+        with probeCacheLock:
+            info = probeCache.get(getFileKey(vid), {})
+        if "error" in info:
+            warn("Skipping %s, the file could not be read: %s" % (vid, info["error"]))
+        else:
+            readable.append(vid)
+    return readable
 
 def getResolution(filePath):
-    cmd = "ffprobe -v error -select_streams v:0 -show_entries stream=width,height -of csv=s=x:p=0 '%s'"%filePath
-    res = check_output(shlex.split(cmd))
-    return res.strip()
+    info = getProbe(filePath)
+    return "%sx%s" % (info["width"], info["height"])
+
+def getVideoFormat(filePath):
+    """
+    Returns a string describing the resolution and codecs of a video file.
+    Segments with the same format can be concatenated by stream copy.
+    """
+    info = getProbe(filePath)
+    return "%sx%s %s %s" % (info["width"], info["height"],
+                            info["videoCodec"], info["audioCodec"])
 
 def all_same(items):
     return all(x == items[0] for x in items)
 
 
+idleFraction = 0.95
+freezeDuration = 2
+
+def isEventSegment(vid):
+    """
+    Returns True if the video segment was saved as an event, i.e. it is in
+    the "EMR" directory or has a copy there.
+    """
+    cardRoot, directory = os.path.split(os.path.dirname(os.path.abspath(vid)))
+    if directory.upper() == "EMR":
+        return True
+    return os.path.isfile(os.path.join(cardRoot, "EMR", os.path.basename(vid)))
+
+def analyzeIdle(vid):
+    """
+    Returns the fraction of the duration of a video segment during which the
+    picture is frozen, i.e. changes by less than idleNoise dB, as detected by
+    the freezedetect filter of FFmpeg on the keyframes. The result is stored
+    in the probe cache, so every segment is only analyzed once.
+    """
+    info = getProbe(vid)
+    if "idleScore" in info:
+        return info["idleScore"]
+    cmd = [ffmpegPath, '-hide_banner', '-nostats', '-skip_frame', 'nokey',
+           '-i', vid, '-an', '-vf', 'freezedetect=n=%sdB:d=%s' % (idleNoise, freezeDuration),
+           '-f', 'null', '-']
+    p = Popen(cmd, stdout=PIPE, stderr=PIPE)
+    err = p.communicate()[1].decode("utf-8", "replace")
+    if p.returncode:
+        warn("Could not analyze %s for idle footage." % vid)
+        return 0.0
+    duration = info["duration"] or 0.0
+    frozen = 0.0
+    start = None
+    for line in err.splitlines():
+        if "freeze_start:" in line:
+            start = float(line.split("freeze_start:")[1])
+        elif "freeze_end:" in line and start is not None:
+            frozen += float(line.split("freeze_end:")[1]) - start
+            start = None
+    if start is not None:
+        # Frozen until the end of the segment
+        frozen += duration - start
+    score = min(frozen / duration, 1.0) if duration > 0 else 0.0
+    with probeCacheLock:
+        info["idleScore"] = score
+    return score
+
+def analyzeTrips(trips):
+    """
+    Analyzes the video segments of trips which may be skipped as idle, that
+    is all segments except the first and last segment of each trip and the
+    event segments, using maxParallelJobs FFmpeg processes.
+    """
+    vids = [vid for vidList, mTime in trips for vid in vidList[1:-1]
+            if not isEventSegment(vid)]
+    with probeCacheLock:
+        missing = [vid for vid in vids if "idleScore" not in probeCache[getFileKey(vid)]]
+    if missing:
+        print("Analyzing %i video segment(s) for idle footage..." % len(missing))
+        pool = ThreadPool(max(1, int(maxParallelJobs)))
+        try:
+            pool.map(analyzeIdle, missing, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        saveProbeCache()
+
+def getActiveSegments(vidList):
+    """
+    Returns the video segments of a trip to be encoded according to
+    idleSegments, as the tuple (segments, decimate). Idle segments are frozen
+    for at least idleFraction of their duration. With "drop", the idle
+    segments are left out. With "decimate", all segments are kept and decimate
+    is True if the trip has idle segments, so repeated frames are dropped
+    while encoding. Stream copies cannot be decimated, so their idle segments
+    are left out instead. The first and last segment of a trip and event
+    segments are always kept.
+    """
+    if idleSegments is None:
+        return vidList, False
+    idle = set(i for i, vid in enumerate(vidList)
+               if 0 < i < len(vidList) - 1 and not isEventSegment(vid) and
+               getProbe(vid).get("idleScore", 0.0) >= idleFraction)
+    if not idle:
+        return vidList, False
+    if idleSegments == "decimate" and codec != "copy":
+        print("Decimating %s, %i of its %i video segment(s) are idle."
+              % (os.path.basename(vidList[0]), len(idle), len(vidList)))
+        return vidList, True
+    print("Leaving out %i idle video segment(s) of the trip starting with %s."
+          % (len(idle), os.path.basename(vidList[0])))
+    return [vid for i, vid in enumerate(vidList) if i not in idle], False
+
+
+manifest = {}
+manifestLock = Lock()
+manifestName = ".ydcc_manifest.jsonl"
+
+def getSettingsHash():
+    """
+    Returns a hash of the settings which affect the content of the output
+    files, so trips are processed again when any of them changes.
+    """
+    settings = [codec, preset, crf, res, downscaler, videoFilters, audioCodec,
+                audioBitrate, author, comment, copyright]
+    if idleSegments is not None:
+        settings += [idleSegments, idleNoise]
+    if targetBitrate is not None or encodeBudget is not None:
+        settings += [targetBitrate, encodeBudget]
+    return hashlib.sha1(json.dumps(settings).encode("utf-8")).hexdigest()
+
+def getFingerprint(vidList):
+    """
+    Returns the path, size and modification time of each video segment.
+    """
+    fingerprint = []
+    for vid in vidList:
+        st = getStat(vid)
+        fingerprint.append([os.path.abspath(vid), st.st_size, st.st_mtime])
+    return fingerprint
+
+def loadManifest():
+    """
+    Loads the manifest of trips archived by previous runs from outputDir. The
+    manifest is a JSON lines file where later records replace earlier records
+    of the same trip.
+    """
+    manifestPath = os.path.join(outputDir, manifestName)
+    if not os.path.isfile(manifestPath):
+        return
+    with open(manifestPath, 'r') as manifestFile:
+        for line in manifestFile:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Ignore a partially written last line
+                continue
+            with manifestLock:
+                manifest[record["trip"]] = record
+
+def isTripArchived(vidList):
+    """
+    Returns True if the trip was archived by a previous run from the same
+    source segments with the same settings and its output files still exist.
+    """
+    with manifestLock:
+        record = manifest.get(os.path.abspath(vidList[0]))
+    if record is None:
+        return False
+    return (record["settings"] == getSettingsHash() and
+            record["sources"] == getFingerprint(vidList) and
+            all(os.path.isfile(o) for o in record["outputs"]))
+
+def recordTrip(vidList, results):
+    """
+    Appends a record of a successfully processed trip to the manifest.
+    """
+    record = {"trip": os.path.abspath(vidList[0]),
+              "sources": getFingerprint(vidList),
+              "settings": getSettingsHash(),
+              "outputs": [result["output"] for result in results]}
+    manifestPath = os.path.join(outputDir, manifestName)
+    with manifestLock:
+        manifest[record["trip"]] = record
+        with open(manifestPath, 'a') as manifestFile:
+            manifestFile.write(json.dumps(record) + "\n")
+
+
+photoBatchSize = 50
+copyBufferSize = 8 * 1024 * 1024
+
+def copyFileFast(src, dst):
+    """
+    Copies the contents of src to dst within the kernel using
+    os.copy_file_range or os.sendfile where the OS supports them, falling back
+    to copying through a buffer of copyBufferSize bytes.
+
+    Returns
+    -------
+    nBytes  :   int
+        Number of bytes copied.
+    """
+    size = os.path.getsize(src)
+    with io.open(src, 'rb') as fsrc:
+        with io.open(dst, 'wb') as fdst:
+            for method in ("copy_file_range", "sendfile"):
+                if not hasattr(os, method):
+                    continue
+                copied = 0
+                try:
+                    while copied < size:
+                        count = min(size - copied, copyBufferSize * 128)
+                        if method == "copy_file_range":
+                            n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), count)
+                        else:
+                            n = os.sendfile(fdst.fileno(), fsrc.fileno(), copied, count)
+                        if n == 0:
+                            break
+                        copied += n
+                    if copied or not size:
+                        return copied
+                    # Nothing copied, which some file systems (FUSE, NFS)
+                    # do instead of failing, so try the next method
+                except OSError:
+                    # Not supported between these files, e.g. across file
+                    # systems on older kernels, try the next method
+                    if copied:
+                        raise
+
+            buf = bytearray(copyBufferSize)
+            view = memoryview(buf)
+            copied = 0
+            while True:
+                n = fsrc.readinto(buf)
+                if not n:
+                    break
+                fdst.write(view[:n])
+                copied += n
+            return copied
+
+def formatThroughput(nBytes, seconds):
+    return "%.1f MB at %.1f MB/s" % (nBytes / 1e6, nBytes / 1e6 / max(seconds, 1e-6))
+
+def isPhotoArchived(file, outFile):
+    """
+    Returns True if outFile is a copy of the photo made by a previous run,
+    i.e. it has the same modification time and the same size, or a smaller
+    size if the photos are optimized.
+    """
+    if not os.path.isfile(outFile):
+        return False
+    src = getStat(file)
+    dst = os.stat(outFile)
+    # Allow for the 2 second resolution of FAT file systems
+    if abs(src.st_mtime - dst.st_mtime) >= 2:
+        return False
+    if optimizePhotos:
+        return dst.st_size <= src.st_size
+    return dst.st_size == src.st_size
+
+def copyPhoto(file):
+    """
+    Copies a photo to outputDir and returns the tuple (file, outFile, nBytes),
+    or None if the photo was already copied by a previous run.
+    """
+    outFile = os.path.join(outputDir, os.path.basename(file))
+    if isPhotoArchived(file, outFile):
+        return None
+    nBytes = copyFileFast(file, outFile)
+    return file, outFile, nBytes
+
+def finishPhotos(pairs):
+    """
+    Optimizes a batch of copied photos with a single jpegoptim call and copies
+    the timestamps of the original photos to them.
+    """
+    if optimizePhotos:
+        cmd = [jpegoptimPath or 'jpegoptim', '-p'] + [outFile for file, outFile in pairs]
+        check_output(cmd)
+    for file, outFile in pairs:
+        copyTimes(file, outFile)
+journal = {}
+journalLock = Lock()
+journalName = ".ydcc_journal.jsonl"
+
+def loadJournal():
+    """
+    Loads the journal left behind by an interrupted previous run from
+    outputDir and removes the temporary files of the trips which the run did
+    not finish, so they are processed again from scratch.
+    """
+    journalPath = os.path.join(outputDir, journalName)
+    if not os.path.isfile(journalPath):
+        return
+    with open(journalPath, 'r') as journalFile:
+        for line in journalFile:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Ignore a partially written last line
+                continue
+            with journalLock:
+                journal[record["trip"]] = record
+
+    nDone = 0
+    for record in journal.values():
+        if record["event"] == "done":
+            nDone += 1
+        else:
+            for tmpPath in (glob(record["base"] + "*.tmp.mp4") +
+                            glob(record["base"] + ".chunk*.mp4")):
+                os.remove(tmpPath)
+    print("Resuming an interrupted run, %i trip(s) were finished and %i trip(s) were not."
+          % (nDone, len(journal) - nDone))
+
+def journalTrip(vidList, mTime, event, results=None):
+    """
+    Appends an event of a trip, "start" or "done", to the journal of the run.
+    """
+    key = os.path.abspath(vidList[0])
+    with journalLock:
+        previous = journal.get(key, {})
+    record = {"trip": key, "event": event}
+    if event == "start":
+        record["base"] = getOutputPath(mTime, getTitleTime(vidList[0]))[:-4]
+    else:
+        record["base"] = previous.get("base")
+        record["sources"] = getFingerprint(vidList)
+        record["settings"] = getSettingsHash()
+        record["outputs"] = [result["output"] for result in results]
+    journalPath = os.path.join(outputDir, journalName)
+    with journalLock:
+        journal[key] = record
+        with open(journalPath, 'a') as journalFile:
+            journalFile.write(json.dumps(record) + "\n")
+
+def isTripFinished(vidList):
+    """
+    Returns True if the trip was finished by the interrupted previous run from
+    the same source segments with the same settings.
+    """
+    with journalLock:
+        record = journal.get(os.path.abspath(vidList[0]))
+    if record is None or record["event"] != "done":
+        return False
+    return (record["settings"] == getSettingsHash() and
+            record["sources"] == getFingerprint(vidList) and
+            all(os.path.isfile(o) for o in record["outputs"]))
+
+def clearJournal():
+    """
+    Removes the journal once the run has finished.
+    """
+    journalPath = os.path.join(outputDir, journalName)
+    with journalLock:
+        journal.clear()
+        if os.path.isfile(journalPath):
+            os.remove(journalPath)
+
+
 def processPhotos(plist):
-    for file in plist:
-        if file.lower().endswith(".jpg"):
-            outFile = os.path.join(outputDir, os.path.basename(file))
-            copyfile(file, outFile)
-            if optimizePhotos:
-                cmd = ['jpegoptim', '-p', outFile]
-                check_output(cmd)
-            atime = os.path.getatime(file)
-            mtime = os.path.getmtime(file)
-            ctime = os.path.getctime(file)
-            os.utime(outFile, (atime, mtime))
-            changeFileCreationTime(outFile, ctime)
+    """
+    Copies the photos to outputDir using photoJobs threads. Copied photos are
+    optimized in batches of photoBatchSize while the remaining photos are
+    still being copied. Photos copied by a previous run are skipped.
+    """
+    photos = [file for file in plist if file.lower().endswith(".jpg")]
+    copyPool = ThreadPool(max(1, int(photoJobs)))
+    finishPool = ThreadPool(max(1, int(photoJobs)))
+    pending = []
+    batch = []
+    nSkipped = 0
+    nBytes = 0
+    start = time()
+    try:
+        for copied in copyPool.imap_unordered(copyPhoto, photos):
+            if copied is None:
+                nSkipped += 1
+                continue
+            batch.append(copied[:2])
+            nBytes += copied[2]
+            if len(batch) >= photoBatchSize:
+                pending.append(finishPool.apply_async(finishPhotos, (batch,)))
+                batch = []
+        copySeconds = time() - start
+        if batch:
+            pending.append(finishPool.apply_async(finishPhotos, (batch,)))
+        for p in pending:
+            p.get()
+    finally:
+        copyPool.close()
+        finishPool.close()
+        copyPool.join()
+        finishPool.join()
+    print("Copied %i photo(s) (%s), skipped %i photo(s) which were already copied."
+          % (len(photos) - nSkipped, formatThroughput(nBytes, copySeconds), nSkipped))
+
+
+def getThreadArgs():
+    """
+    Returns the FFmpeg arguments limiting the number of threads each job may
+    use, or an empty list if ffmpegThreads was not specified.
+    """
+    if ffmpegThreads:
+        return ['-threads', str(ffmpegThreads)]
+    return []
+
+
+def splitRuns(vidList, formats):
+    """
+    Splits a trip into runs of consecutive segments which share the same
+    video format.
+
+    Parameters
+    ----------
+    vidList :   list of str
+        Paths to the video segments of the trip.
+    formats :   list of str
+        Video format of each segment, as returned by getVideoFormat.
+
+    Returns
+    -------
+    runs    :   list of list of str
+        The segments of the trip split into runs, in their original order.
+    """
+    runs = [[vidList[0]]]
+    for i in range(1, len(vidList)):
+        if formats[i] == formats[i-1]:
+            runs[-1].append(vidList[i])
+        else:
+            runs.append([vidList[i]])
+    return runs
+
+
+def processTrip(trip, verifyPool=None):
+    """
+    Processes a single trip, a tuple of (vidList, mTime), and returns the
+    results of the job as a list with one result per output file.
+
+    If verifyPool is given, the output files are verified by the pool so the
+    next trip can be encoded in the meantime, and an AsyncResult of the
+    results is returned instead.
+    """
+    vidList, mTime = trip
+    journalTrip(vidList, mTime, "start")
+    # The trip is recorded with all of its segments, even if idle segments
+    # are left out of the output
+    segments, decimate = getActiveSegments(vidList)
+    params = getTripParams(segments)
+    params["decimate"] = decimate
+    formats = [getVideoFormat(vid) for vid in segments]
+    # The chunks are encoded by processVideosBasic, which applies videoFilters
+    # to each chunk
+    if (all_same(formats) and codec != "copy" and
+            chunkSegments and len(segments) > int(chunkSegments)):
+        results = [processVideosChunked(segments, mTime, params)]
+    elif all_same(formats) and videoFilters is None:
+        results = [processVideosBasic(segments, mTime, params=params)]
+    elif codec == "copy":
+        # Stream copy each run of identical segments into its own part
+        # instead of re-encoding the whole trip.
+        fTime = getTitleTime(segments[0])
+        runs = splitRuns(segments, formats)
+        results = [processVideosBasic(run, mTime, fTime, part+1)
+                   for part, run in enumerate(runs)]
+    else:
+        results = [processVideosComplex(segments, mTime, params)]
+
+    # Record the parameters chosen for the trip and their predicted cost
+    seconds, megapixels = estimateTripCost(segments, params)
+    for result in results:
+        result["costKey"] = getCostKey(params)
+        result["megapixels"] = megapixels
+        result["predictedSeconds"] = seconds / len(results)
+        result["crf"] = params["crf"]
+        result["preset"] = params["preset"]
+        result["predictedBitrate"] = params.get("predictedBitrate")
+    if verifyPool is None:
+        return verifyTrip(vidList, results)
+    return verifyPool.apply_async(verifyTrip, (vidList, results))
+
+
+def getProxyParams():
+    """
+    Returns the encoding parameters of the proxy videos of trips whose video
+    segments have identical formats.
+    """
+    if proxyCodec == "copy":
+        return {"codec": "copy", "preset": None, "crf": None, "proxy": True}
+    return {"codec": "libx264", "preset": "ultrafast", "crf": crf, "proxy": True}
+
+def processProxy(trip, verifyPool=None):
+    """
+    Quickly creates a proxy video of a trip so it can be reviewed before the
+    archive quality video is done. The proxy is a stream copy if proxyCodec is
+    "copy" and the segments have identical formats, otherwise it is encoded
+    with libx264 using the "ultrafast" preset. It is written to the proxy
+    path of the trip, see getProxyPath, so a run which stops before the
+    archive video is done never leaves a proxy under the name of the archive
+    video. See processTrip for the parameters and return value.
+    """
+    vidList, mTime = trip
+    formats = [getVideoFormat(vid) for vid in vidList]
+    if proxyCodec == "copy" and all_same(formats):
+        params = getProxyParams()
+        results = [processVideosBasic(vidList, mTime, params=params)]
+    else:
+        params = {"codec": "libx264", "preset": "ultrafast", "crf": crf,
+                  "proxy": True}
+        if all_same(formats) and videoFilters is None:
+            results = [processVideosBasic(vidList, mTime, params=params)]
+        else:
+            results = [processVideosComplex(vidList, mTime, params=params)]
+
+    if verifyPool is None:
+        return verifyTrip(vidList, results, record=False)
+    return verifyPool.apply_async(verifyTrip, (vidList, results, False))
+
+
+def groupTrips(vlist):
+    """
+    Groups the video segments into trips. Consecutive segments belong to the
+    same trip if no more than maxDiff seconds passed between them.
+
+    Parameters
+    ----------
+    vlist   :   list of str
+        Paths to the video segments, in any order.
+
+    Returns
+    -------
+    trips   :   list of tuple
+        One (vidList, mTime) tuple per trip in chronological order, where
+        vidList are the paths to the segments of the trip and mTime is the
+        date the trip started.
+    """
+    # Parse every name once and sort once by the start time of the segments
+    segments = []
+    for vid in vlist:
+        segment = parseSegmentName(vid)
+        if segment is None:
+            warn("Skipping %s, could not parse the date and time from its name." % vid)
+        else:
+            segments.append((segment[2], vid, segment[0]))
+    if not segments:
+        return []
+    segments.sort()
+    stimes = [segment[0] for segment in segments]
+
+    # Split the trips in a single pass over the gaps between the segments.
+    # The gaps are computed from the full date and time, so trips which
+    # continue past midnight are not split.
+    ind_newVids = getIndNewVids(stimes, maxDiff) + [len(segments)]
+    trips = []
+    for i in range(len(ind_newVids) - 1):
+        tripSegments = segments[ind_newVids[i]:ind_newVids[i+1]]
+        trips.append(([segment[1] for segment in tripSegments],
+                      tripSegments[0][2]))
+
+    return trips
 
 
 def processVideos(vlist):
-    mTimes = [getTitleDate(vid) for vid in vlist]
-    mTimes = list(set(mTimes))
+    """
+    Groups the video segments into trips and processes independent trips
+    concurrently, running at most maxParallelJobs FFmpeg jobs at a time.
+
+    Parameters
+    ----------
+    vlist   :   list of str
+        Paths to the video segments to be processed.
+
+    Returns
+    -------
+    results :   list of dict
+        One result per output file with the keys "inputs", "output" and
+        "error", where "error" is None if the file was processed successfully.
+    """
+    # Segments which could not be read by previous runs are left out before
+    # the trips are grouped, so the trips match the ones in the manifest
+    trips = groupTrips(dropUnreadable(vlist))
+
+    # Skip the trips archived by previous runs before probing anything
+    if incrementalArchive:
+        nTrips = len(trips)
+        trips = [trip for trip in trips if not isTripArchived(trip[0])]
+        if nTrips > len(trips):
+            print("Skipping %i trip(s) which were already archived." % (nTrips - len(trips)))
+
+    # Skip the trips finished by an interrupted previous run
+    trips = [trip for trip in trips if not isTripFinished(trip[0])]
+
+    segments = [vid for trip in trips for vid in trip[0]]
+    probeVideos(segments)
+    readable = dropUnreadable(segments)
+    if len(readable) < len(segments):
+        trips = groupTrips(readable)
+    if idleSegments is not None:
+        analyzeTrips(trips)
+
+    if twoStageEncode and codec != "copy" and trips:
+        # Create a proxy of every trip first, then encode the archive quality
+        # videos and remove the proxies they replace.
+        with promptLock:
+            for vidList, mTime in trips:
+                # Proxies left behind by a previous run are replaced without asking
+                proxyPath = getProxyPath(getOutputPath(mTime, getTitleTime(vidList[0])))
+                overwriteDecisions[proxyPath] = True
+        proxyResults = runTrips(trips, processProxy, getProxyParams())
+        nFailed = len([r for r in proxyResults if r["error"]])
+        if nFailed:
+            warn("Could not create the proxy videos of %i trip(s), their archive videos are still encoded." % nFailed)
+        print("Proxy videos of %i trip(s) are ready for review, encoding the archive videos..."
+              % (len(proxyResults) - nFailed))
+        results = runTrips(trips, processTrip)
+        failed = set(r["final"] for r in results if r["error"])
+        for r in proxyResults:
+            archivePath = r["final"][:-len(".proxy.mp4")] + ".mp4"
+            if (archivePath not in failed and os.path.isfile(archivePath) and
+                    os.path.isfile(r["final"])):
+                try:
+                    os.remove(r["final"])
+                except OSError as e:
+                    # e.g. the proxy is still open in a video player on Windows
+                    warn("Could not remove the proxy video %s: %s" % (r["final"], e))
+        return results
+
+    return runTrips(trips, processTrip)
+
+
+# Encoding time in seconds per second of video and megapixel of resolution,
+# or per second of video for "copy". The defaults are for libx264 with the
+# "medium" preset on a typical desktop PC, scaled by presetFactors, and are
+# replaced by the rates measured by previous runs (see loadEncodeRates).
+defaultEncodeRates = {"copy": 0.002, "libx264": 0.1, "libx265": 0.4}
+presetFactors = {"ultrafast": 0.2, "superfast": 0.3, "veryfast": 0.45,
+                 "faster": 0.6, "fast": 0.8, "medium": 1.0, "slow": 1.6,
+                 "slower": 3.0, "veryslow": 6.0, "placebo": 12.0}
+encodeRates = {}
+reportHistory = 20
+
+def getCostKey(params):
+    """
+    Returns the key of the encode rate of the encoding parameters params.
+    """
+    if params["codec"] == "copy":
+        return "copy"
+    return "%s/%s" % (params["codec"], params["preset"])
+
+def loadEncodeRates():
+    """
+    Calibrates encodeRates from the jobs of the last reportHistory run
+    reports in outputDir, using the median rate of each codec and preset.
+    """
+    rates = {}
+    for reportPath in sorted(glob(os.path.join(outputDir, "ydcc_report_*.json")))[-reportHistory:]:
+        try:
+            with open(reportPath, 'r') as reportFile:
+                jobs = json.load(reportFile)["jobs"]
+        except (IOError, OSError, ValueError, KeyError):
+            continue
+        for job in jobs:
+            if (job.get("costKey") and not job["error"] and job.get("megapixels") and
+                    job["mediaSeconds"] > 0 and job["encodeSeconds"] > 0):
+                work = job["mediaSeconds"]
+                if job["costKey"] != "copy":
+                    work *= job["megapixels"]
+                rates.setdefault(job["costKey"], []).append(job["encodeSeconds"] / work)
+    encodeRates.clear()
+    for key, values in rates.items():
+        values.sort()
+        encodeRates[key] = values[len(values) // 2]
+
+def estimateTripCost(vidList, params):
+    """
+    Estimates the encoding time of a trip with the encoding parameters params.
+
+    Returns
+    -------
+    seconds :   float
+        Predicted encoding time of the trip.
+    megapixels  :   float
+        Resolution of the video segments of the trip.
+    """
+    mediaSeconds = 0.0
+    pixels = 0.0
+    for vid in vidList:
+        probe = getProbe(vid) or {}
+        mediaSeconds += probe.get("duration") or 60.0
+        pixels += (probe.get("width") or 0) * (probe.get("height") or 0)
+    megapixels = pixels / len(vidList) / 1e6 or 1.0
+    rate = getEncodeRate(params)
+    if params["codec"] == "copy":
+        return mediaSeconds * rate, megapixels
+    return mediaSeconds * megapixels * rate, megapixels
+
+def getEncodeRate(params):
+    """
+    Returns the encode rate of the encoding parameters params, as measured by
+    previous runs or estimated from defaultEncodeRates and presetFactors.
+    """
+    rate = encodeRates.get(getCostKey(params))
+    if rate is None:
+        rate = (defaultEncodeRates.get(params["codec"], defaultEncodeRates["libx264"]) *
+                presetFactors.get(params["preset"], 1.0))
+    return rate
+
+
+# Presets of libx264 and libx265 from the fastest to the slowest
+presetOrder = ["ultrafast", "superfast", "veryfast", "faster", "fast",
+               "medium", "slow", "slower", "veryslow", "placebo"]
+referenceCRF = 23
+sampleSeconds = 2
+sampleSegments = 3
 
-    for mTime in mTimes:
-        vidDateList = [vid for vid in vlist if getTitleDate(vid) == mTime]
+def measureComplexity(vid):
+    """
+    Measures the complexity of a video segment as the bitrate in kbit/s of a
+    sampleSeconds long sample from its middle, encoded with videoFilters at
+    the output resolution with referenceCRF and the "veryfast" preset of
+    codec. The result is stored in the probe cache, so every segment is only
+    measured once per codec, filters and resolution. Returns None if the
+    measurement failed.
+    """
+    info = getProbe(vid)
+    key = "complexity_%s_%s_%s" % (codec, videoFilters, res)
+    if key in info:
+        return info[key]
+    start = max((info["duration"] or 0.0) / 2 - sampleSeconds / 2.0, 0.0)
+    fd, samplePath = tempfile.mkstemp(prefix="ydcc_", suffix=".mkv")
+    os.close(fd)
+    cmd = [ffmpegPath, '-hide_banner', '-nostdin', '-v', 'error', '-y',
+           '-ss', str(start), '-t', str(sampleSeconds), '-i', getInputPath(vid),
+           '-an']
+    filters = [f for f in (videoFilters, res and "scale=%s" % res) if f]
+    if filters:
+        cmd += ['-vf', ",".join(filters)]
+    cmd += ['-c:v', codec, '-preset', 'veryfast', '-crf', str(referenceCRF),
+            samplePath]
+    try:
+        with getEncodeSlots():
+            retCode = call(cmd)
+        kbps = os.path.getsize(samplePath) * 8 / 1000.0 / sampleSeconds
+    finally:
+        os.remove(samplePath)
+    if retCode or kbps <= 0:
+        warn("Could not measure the complexity of %s." % vid)
+        return None
+    with probeCacheLock:
+        info[key] = kbps
+    return kbps
+
+def getTripParams(vidList):
+    """
+    Returns the encoding parameters of a trip. By default these are the
+    settings, but if targetBitrate or encodeBudget is set, the CRF and preset
+    are chosen per trip:
+
+    - targetBitrate: the bitrate of the trip is predicted from the complexity
+      of sampleSegments of its video segments, and the CRF is raised above
+      the CRF setting as far as needed to stay below targetBitrate kbit/s,
+      assuming the bitrate halves for every 6 CRF.
+    - encodeBudget: the slowest preset up to the speed setting is chosen
+      whose predicted encoding time stays within encodeBudget seconds per
+      hour of video.
+
+    The predicted bitrate is stored in the parameters as "predictedBitrate".
+    """
+    params = getEncodeParams()
+    if codec == "copy" or (targetBitrate is None and encodeBudget is None):
+        return params
+
+    if targetBitrate is not None:
+        step = max(1, len(vidList) // sampleSegments)
+        samples = vidList[::step][:sampleSegments]
+        measured = [kbps for kbps in map(measureComplexity, samples) if kbps]
+        saveProbeCache()
+        if not measured:
+            return params
+        kbps = sum(measured) / len(measured)
+        crf = max(float(params["crf"]), referenceCRF + 6 * math.log(kbps / targetBitrate, 2))
+        crf = min(int(math.ceil(crf)), 51)
+        params["predictedBitrate"] = kbps * 2 ** ((referenceCRF - crf) / 6.0)
+        params["crf"] = crf
+
+    if encodeBudget is not None:
+        # The encode rates are per megapixel of the video segments, see
+        # estimateTripCost
+        megapixels = estimateTripCost(vidList, params)[1]
+        if params["preset"] in presetOrder:
+            presets = presetOrder[:presetOrder.index(params["preset"]) + 1]
+        else:
+            presets = presetOrder
+        for preset in reversed(presets):
+            params["preset"] = preset
+            if 3600 * megapixels * getEncodeRate(params) <= float(encodeBudget):
+                break
+
+    return params
+
+
+stagedFiles = {}
+stagingCondition = Condition()
+
+def getInputPath(vid):
+    """
+    Returns the path FFmpeg should read the video segment vid from, which is
+    its copy in the staging directory if it has been staged.
+    """
+    return stagedFiles.get(vid, vid)
+
+def stageTrips(trips, staging):
+    """
+    Copies the video segments of trips, in order and one file at a time, to
+    the staging directory while earlier trips are being encoded. At most
+    stagingSizeGB of video segments are staged at once, so the copying waits
+    for processed trips to be evicted. Trips larger than stagingSizeGB, or
+    which fail to copy, are read directly from the SD card.
+    """
+    maxBytes = float(stagingSizeGB) * 1e9
+    for vidList, mTime in trips:
+        size = sum(getStat(vid).st_size for vid in vidList)
+        fits = size <= maxBytes
+        with stagingCondition:
+            while (fits and staging["bytes"] > 0 and
+                   staging["bytes"] + size > maxBytes and not staging["stop"]):
+                stagingCondition.wait()
+            if staging["stop"]:
+                return
+            if fits:
+                staging["bytes"] += size
+
+        staged = {}
+        if fits:
+            try:
+                for vid in vidList:
+                    # Movie and EMR segments can have the same name
+                    stagedPath = os.path.join(staging["dir"], "%s_%s" % (
+                        os.path.basename(os.path.dirname(vid)), os.path.basename(vid)))
+                    start = time()
+                    nBytes = copyFileFast(vid, stagedPath)
+                    staged[vid] = stagedPath
+                    staging["copiedBytes"] += nBytes
+                    staging["copySeconds"] += time() - start
+            except (IOError, OSError) as e:
+                warn("Could not stage %s, reading it from the SD card instead: %s" % (vid, e))
+                for stagedPath in staged.values():
+                    os.remove(stagedPath)
+                staged = {}
+
+        with stagingCondition:
+            if fits and not staged:
+                staging["bytes"] -= size
+            stagedFiles.update(staged)
+            staging["trips"][vidList[0]] = (staged, size if staged else 0)
+            stagingCondition.notify_all()
+
+def startStaging(trips):
+    """
+    Starts staging trips in the background if stagingDir is set.
+
+    Returns
+    -------
+    staging :   dict or None
+        State of the staging, to be passed to runStaged and stopStaging.
+    """
+    if stagingDir is None:
+        return None
+    if not os.path.isdir(stagingDir):
+        os.makedirs(stagingDir)
+    staging = {"dir": tempfile.mkdtemp(prefix="ydcc_stage_", dir=stagingDir),
+               "bytes": 0, "trips": {}, "stop": False,
+               "copiedBytes": 0, "copySeconds": 0.0}
+    staging["thread"] = Thread(target=stageTrips, args=(trips, staging))
+    staging["thread"].daemon = True
+    staging["thread"].start()
+    return staging
+
+def runStaged(func, staging, trip, verifyPool=None):
+    """
+    Waits until trip has been staged, runs func on it and evicts its staged
+    video segments afterwards.
+    """
+    key = trip[0][0]
+    with stagingCondition:
+        while key not in staging["trips"] and staging["thread"].is_alive():
+            stagingCondition.wait(1.0)
+    try:
+        return func(trip, verifyPool=verifyPool)
+    finally:
+        with stagingCondition:
+            staged, size = staging["trips"].pop(key, ({}, 0))
+            for vid, stagedPath in staged.items():
+                stagedFiles.pop(vid, None)
+                os.remove(stagedPath)
+            staging["bytes"] -= size
+            stagingCondition.notify_all()
+
+def stopStaging(staging):
+    """
+    Stops the staging and removes the staging directory.
+    """
+    if staging is None:
+        return
+    with stagingCondition:
+        staging["stop"] = True
+        stagingCondition.notify_all()
+    staging["thread"].join()
+    with stagingCondition:
+        for staged, size in staging["trips"].values():
+            for vid in staged:
+                stagedFiles.pop(vid, None)
+    rmtree(staging["dir"], ignore_errors=True)
+    if staging["copiedBytes"]:
+        print("Staged %s." % formatThroughput(staging["copiedBytes"], staging["copySeconds"]))
+
+
+def runTrip(func, trip, verifyPool=None):
+    """
+    Runs func on trip unless the run was interrupted. An exception raised by
+    func only fails this trip, see getTripError.
+    """
+    if stopEvent.is_set():
+        raise RunInterrupted("The run was interrupted.")
+    try:
+        return func(trip, verifyPool=verifyPool)
+    except RunInterrupted:
+        raise
+    except Exception as e:
+        return getTripError(trip, e)
+
+def getTripError(trip, e):
+    """
+    Returns the results of a trip whose processing raised the exception e.
+    """
+    vidList, mTime = trip
+    outputPath = getOutputPath(mTime, getTitleTime(vidList[0]))
+    warn("ERROR: Could not process %s: %s" % (outputPath, e))
+    return [{"inputs": vidList, "output": outputPath, "final": outputPath,
+             "encoded": False, "stats": {}, "error": str(e)}]
 
-        stimes = empty(len(vidDateList))
-        for i in range(len(vidDateList)):
-            vid = vidDateList[i]
-            t = vid.split("_")[-1][:-4]
-            stimes[i] = float(t[:2]) * 3600 + float(t[2:4]) * 60 + float(t[4:])
+# Timeout in seconds of waiting for the jobs of a pool, long enough to never
+# expire
+waitTimeout = 30 * 24 * 3600
 
-        ind_newVids = getIndNewVids(stimes, maxDiff)
+def runTrips(trips, func, params=None):
+    """
+    Runs func, processTrip or processProxy, on all trips using at most
+    maxParallelJobs concurrent jobs and returns the results of all output
+    files. If stagingDir is set, the video segments of the next trips are
+    staged while the current trips are processed.
+
+    The trips are started in order of their predicted encoding time with the
+    encoding parameters params, longest first, so a long trip does not end
+    up running alone at the end of the run.
+    """
+    if params is None:
+        params = getEncodeParams()
+    costs = dict((trip[0][0], estimateTripCost(trip[0], params)) for trip in trips)
+    trips = sorted(trips, key=lambda trip: -costs[trip[0][0]][0])
+    if len(trips) > 1:
+        print("Predicted encoding time of %i trip(s): %s"
+              % (len(trips), formatDuration(sum(cost[0] for cost in costs.values()))))
+
+    staging = startStaging(trips)
+    if staging is not None:
+        func = partial(runStaged, func, staging)
+    func = partial(runTrip, func)
+    pool = ThreadPool(max(1, int(maxParallelJobs)))
+    verifyPool = ThreadPool(max(1, int(maxParallelJobs)))
+    try:
+        # Waiting with a timeout lets Python 2 deliver KeyboardInterrupt
+        pending = pool.map_async(partial(func, verifyPool=verifyPool), trips,
+                                 chunksize=1).get(waitTimeout)
+        tripResults = []
+        for trip, p in zip(trips, pending):
+            if isinstance(p, list):
+                tripResults.append(p)
+                continue
+            try:
+                # Verification errors of the trip
+                tripResults.append(p.get(waitTimeout))
+            except RunInterrupted:
+                raise
+            except Exception as e:
+                tripResults.append(getTripError(trip, e))
+    except BaseException:
+        # Do not start the remaining trips after Ctrl+C or an error
+        pool.terminate()
+        verifyPool.terminate()
+        raise
+    else:
+        pool.close()
+        verifyPool.close()
+    finally:
+        pool.join()
+        verifyPool.join()
+        stopStaging(staging)
+
+    for trip, results in zip(trips, tripResults):
+        seconds, megapixels = costs[trip[0][0]]
+        for result in results:
+            # Unless func chose different parameters for the trip
+            result.setdefault("costKey", getCostKey(params))
+            result.setdefault("megapixels", megapixels)
+            result.setdefault("predictedSeconds", seconds / len(results))
+    return [result for results in tripResults for result in results]
+
+
+
+def getOutputPath(mTime, fTime, part=None):
+    """
+    Returns the path of the output file of a trip. Trips which are split into
+    multiple parts get a "_partNN" suffix per part.
+    """
+    if part is None:
+        return "%s/%s_%s_trip.mp4" % (outputDir, mTime, fTime)
+    return "%s/%s_%s_trip_part%02i.mp4" % (outputDir, mTime, fTime, part)
 
-        for i in range(len(ind_newVids) - 1):
-            istart = int(ind_newVids[i])
-            iend = int(ind_newVids[i + 1])
-            vidList = vidDateList[istart:iend]
 
-            resolutions = [getResolution(vid) for vid in vidList]
-            if all_same(resolutions) and videoFilters is None:
-                processVideosBasic(vidList, mTime)
+overwriteDecisions = {}
+
+def shouldWriteOutput(outputPath):
+    """
+    Returns True if outputPath should be written. If the file already exists,
+    it is overwritten according to overwriteExistingVideo, or after asking the
+    user if overwriteExistingVideo is None. The decision is remembered for the
+    rest of the run.
+    """
+    if not os.path.isfile(outputPath):
+        return True
+    with promptLock:
+        if outputPath not in overwriteDecisions:
+            if overwriteExistingVideo is None:
+                ans = raw_input("File '%s' already exists. Overwrite ? [y/N] "%outputPath) or "N"
+                overwriteDecisions[outputPath] = ans.lower() in ("y", "yes")
             else:
-                processVideosComplex(vidList, mTime)
+                overwriteDecisions[outputPath] = bool(overwriteExistingVideo)
+        return overwriteDecisions[outputPath]
+
+
+def encodeVideo(cmd, vidList, outputPath, finalPath=None):
+    """
+    Runs the FFmpeg command encoding vidList into outputPath and returns the
+    result of the job. The output file is not verified here, see verifyVideo,
+    which also moves it to finalPath if that is a different path.
 
-        istart = ind_newVids[-1]
-        vidList = vidDateList[istart:]
-        resolutions = [getResolution(vid) for vid in vidList]
-        if all_same(resolutions) and videoFilters is None:
-            processVideosBasic(vidList, mTime)
+    If finalPath already exists, it is only written according to
+    overwriteExistingVideo. The temporary outputPath is always overwritten,
+    since it can only be left behind by an interrupted run.
+    """
+    result = {"inputs": vidList, "output": outputPath, "error": None,
+              "final": finalPath or outputPath, "encoded": False, "stats": {},
+              "expected": getExpectedStats(vidList),
+              "inputBytes": sum(getStat(vid).st_size for vid in vidList)}
+    if not shouldWriteOutput(result["final"]):
+        print("Skipping %s, the file already exists." % result["final"])
+        result["output"] = result["final"]
+        return result
+
+    # Limit the threads used by this job, inserted before the output path
+    cmd[-1:-1] = getThreadArgs()
+    cmd.append("-y")
+
+    encodeRetCode = callFFmpeg(cmd, result["stats"],
+                               result["expected"]["duration"])
+    if encodeRetCode:
+        warn("ERROR: Encoding process returned a %s error code.\n%s"
+             % (encodeRetCode, result["stats"]["errors"]))
+        result["error"] = "Encoding process returned a %s error code."%encodeRetCode
+        # The journal is cleared at the end of the run, so nothing else
+        # would remove the partial file
+        if outputPath != result["final"] and os.path.isfile(outputPath):
+            os.remove(outputPath)
+    result["encoded"] = encodeRetCode == 0
+    return result
+
+
+def verifyVideo(result):
+    """
+    Checks the integrity of a freshly encoded output file against its source
+    segments and copies the timestamps of the first segment to it.
+    """
+    if result["encoded"]:
+        outputPath = result["output"]
+        vidList = result["inputs"]
+        start = time()
+        if verifyLevel == "inline":
+            retCode = checkEncodeStats(outputPath, result["stats"], result["expected"])
+        elif verifyLevel == "sampled" and not result.get("streamCopy"):
+            # Only stream copies reuse the packets of the checked segments
+            retCode = checkVideoFile(outputPath, result["expected"], "decode")
         else:
-            processVideosComplex(vidList, mTime)
+            retCode = checkVideoFile(outputPath, result["expected"])
+        result["verifySeconds"] = time() - start
+        if retCode:
+            warn("ERROR: Integrity check of %s failed!"%outputPath)
+            result["error"] = "Integrity check failed."
+        copyTimes(vidList[0], outputPath)
+        if result["final"] != outputPath:
+            if result["error"]:
+                # Keep the existing output instead of the failed replacement
+                os.remove(outputPath)
+            else:
+                replaceFile(outputPath, result["final"])
+                result["output"] = result["final"]
+    return result
+
+
+def verifyTrip(vidList, results, record=True):
+    """
+    Verifies all output files of a trip. If every output passed and record is
+    True, the trip is recorded in the manifest and marked as done in the
+    journal.
+    """
+    results = [verifyVideo(result) for result in results]
+    if record and not any(result["error"] for result in results):
+        if incrementalArchive:
+            recordTrip(vidList, results)
+        journalTrip(vidList, None, "done", results)
+    return results
+
+
+def getEncodeParams():
+    """
+    Returns the encoding parameters from the settings. A different set of
+    parameters can be passed to processVideosBasic and processVideosComplex.
+    """
+    return {"codec": codec, "preset": preset, "crf": crf}
+
 
+def getProxyPath(outputPath):
+    """
+    Returns the path of the proxy video of the output file outputPath.
+    """
+    return outputPath[:-4] + ".proxy.mp4"
+
+
+def getTempPath(outputPath):
+    """
+    Returns the path an output file is written to before it replaces
+    outputPath.
+    """
+    return outputPath[:-4] + ".tmp.mp4"
 
 
-def processVideosBasic(vidList, mTime):
-    with open("vidList.txt", 'w') as listFile:
+def writeConcatList(vidList):
+    """
+    Writes the list of video segments for the concat demuxer to a new file in
+    the temporary directory of the system, so concurrent jobs and runs never
+    share a list file.
+
+    Returns
+    -------
+    listPath    :   str
+        Path to the list file, to be removed by the caller.
+    """
+    fd, listPath = tempfile.mkstemp(prefix="ydcc_", suffix=".txt")
+    with os.fdopen(fd, 'w') as listFile:
         for vid in vidList:
-            listFile.write("file '%s'\n" % vid)
-    fTime = getTitleTime(vidList[0])
-    outputPath = "%s/%s_%s_trip.mp4" % (outputDir, mTime, fTime)
-    localmtime = getLocalmtime(vidList[0])
+            # Single quotes in paths must be escaped for the concat demuxer
+            listFile.write("file '%s'\n" % os.path.abspath(getInputPath(vid)).replace("'", "'\\''"))
+    return listPath
+
+
+def replaceFile(src, dst):
+    """
+    Renames src to dst, replacing dst if it exists.
+    """
+    if hasattr(os, "replace"):
+        os.replace(src, dst)
+    else:
+        if os.name == "nt" and os.path.isfile(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def addDecimation(cmd):
+    """
+    Adds the mpdecimate filter, which drops frames that barely differ from
+    the previous frame, to the FFmpeg command cmd. The timestamps of the
+    remaining frames are kept, so the video stays in sync with the audio.
+    """
+    if '-vf' in cmd:
+        i = cmd.index('-vf') + 1
+        cmd[i] = "mpdecimate," + cmd[i]
+    else:
+        cmd[-1:-1] = ['-vf', 'mpdecimate']
+    cmd[-1:-1] = ['-vsync', 'vfr']
+
+
+def processVideosBasic(vidList, mTime, fTime=None, part=None, params=None,
+                       outputPath=None, sources=None):
+    """
+    Concatenates video segments with identical formats using the concat
+    demuxer.
+
+    Parameters
+    ----------
+    vidList :   list of str
+        Paths to the video segments.
+    mTime   :   str
+        Date of the trip.
+    fTime   :   str, optional
+        Time of the trip, defaults to the time of the first segment.
+    part    :   int, optional
+        Number of the part if the trip is split into multiple parts.
+    params  :   dict, optional
+        Encoding parameters as returned by getEncodeParams.
+    outputPath  :   str, optional
+        Path to write the output to instead of the output file of the trip.
+        By default, the output is written to a temporary file which replaces
+        the output file of the trip once it has been verified.
+    sources :   list of str, optional
+        Original video segments of the trip, if vidList are intermediate
+        files made from them. Used for the metadata, timestamps and
+        verification of the output.
+    """
+    if params is None:
+        params = getEncodeParams()
+    codec, preset, crf = params["codec"], params["preset"], params["crf"]
+    if sources is None:
+        sources = vidList
+    if fTime is None:
+        fTime = getTitleTime(vidList[0])
+    if outputPath is None:
+        finalPath = getOutputPath(mTime, fTime, part)
+        if params.get("proxy"):
+            finalPath = getProxyPath(finalPath)
+        outputPath = getTempPath(finalPath)
+    else:
+        finalPath = outputPath
+    listPath = writeConcatList(vidList)
+    creationTime = getUTCmtime(sources[0])
     if codec == "copy":
         cmd = [ffmpegPath, '-hide_banner', '-f', 'concat', '-safe', '0',
-               '-i', 'vidList.txt',
-               '-metadata', 'creation_time=%s'%str(localmtime),
+               '-i', listPath,
+               '-metadata', 'creation_time=%s' % creationTime,
                '-metadata', 'artist="%s"'%author,
                '-metadata', 'author="%s"'%author,
                '-metadata', 'album_author="%s"'%author,
@@ -294,8 +2089,8 @@ def processVideosBasic(vidList, mTime):
         if res is None and videoFilters is None:
             cmd = [ffmpegPath, '-hide_banner', '-f', 'concat', '-safe',
                    '0',
-                   '-i', 'vidList.txt',
-                   '-metadata', 'creation_time=%s' % str(localmtime),
+                   '-i', listPath,
+                   '-metadata', 'creation_time=%s' % creationTime,
                    '-metadata', 'artist="%s"' % author,
                    '-metadata', 'author="%s"' % author,
                    '-metadata', 'album_author="%s"' % author,
@@ -308,8 +2103,8 @@ def processVideosBasic(vidList, mTime):
         elif res is not None and videoFilters is None:
             cmd = [ffmpegPath, '-hide_banner', '-f', 'concat', '-safe',
                    '0',
-                   '-i', 'vidList.txt',
-                   '-metadata', 'creation_time=%s' % str(localmtime),
+                   '-i', listPath,
+                   '-metadata', 'creation_time=%s' % creationTime,
                    '-metadata', 'artist="%s"' % author,
                    '-metadata', 'author="%s"' % author,
                    '-metadata', 'album_author="%s"' % author,
@@ -323,8 +2118,8 @@ def processVideosBasic(vidList, mTime):
         elif res is None and videoFilters is not None:
             cmd = [ffmpegPath, '-hide_banner', '-f', 'concat', '-safe',
                    '0',
-                   '-i', 'vidList.txt',
-                   '-metadata', 'creation_time=%s' % str(localmtime),
+                   '-i', listPath,
+                   '-metadata', 'creation_time=%s' % creationTime,
                    '-metadata', 'artist="%s"' % author,
                    '-metadata', 'author="%s"' % author,
                    '-metadata', 'album_author="%s"' % author,
@@ -338,8 +2133,8 @@ def processVideosBasic(vidList, mTime):
         elif res is not None and videoFilters is not None:
             cmd = [ffmpegPath, '-hide_banner', '-f', 'concat', '-safe',
                    '0',
-                   '-i', 'vidList.txt',
-                   '-metadata', 'creation_time=%s' % str(localmtime),
+                   '-i', listPath,
+                   '-metadata', 'creation_time=%s' % creationTime,
                    '-metadata', 'artist="%s"' % author,
                    '-metadata', 'author="%s"' % author,
                    '-metadata', 'album_author="%s"' % author,
@@ -358,62 +2153,131 @@ def processVideosBasic(vidList, mTime):
         raise ValueError(
             "User-specified codec, %s, is not valid." % codec)
 
-    if overwriteExistingVideo:
-        cmd.append("-y")
-    elif overwriteExistingVideo is False:
-        cmd.append("-n")
-    else:
-        # Otherwise, ffmpeg was ask user at command line each time
-        pass
+    if params.get("decimate") and codec != "copy":
+        addDecimation(cmd)
 
-    atime = os.path.getatime(vidList[0])
-    mtime = os.path.getmtime(vidList[0])
-    encodeRetCode = callFFmpeg(cmd)
-    if encodeRetCode and (encodeRetCode != -1):
-        warn("ERROR: Encoding process returned a %s error code."%encodeRetCode)
-        errorVideos.append(outputPath)
-    if  encodeRetCode==0:
-        if checkVideoFile(outputPath):
-            warn("ERROR: Integrity check of %s failed!"%outputPath)
-            errorVideos.append(outputPath)
-        else:
+    # Additional output options, inserted before the output path
+    cmd[-1:-1] = params.get("extraArgs", [])
+
+    try:
+        result = encodeVideo(cmd, sources, outputPath, finalPath)
+        # The output consists of the packets of the source segments
+        result["streamCopy"] = codec == "copy" and sources is vidList
+        if params.get("decimate") and "expected" in result:
+            # Decimated outputs have fewer frames than the segments
+            result["expected"]["frames"] = None
+    finally:
+        try:
+            os.remove(listPath)
+        except OSError:
             pass
-        os.utime(outputPath, (atime, mtime))
-        changeFileCreationTime(outputPath, os.path.getctime(vidList[0]))
 
+    return result
+
+
+def processVideosChunked(vidList, mTime, params=None):
+    """
+    Encodes a long trip in chunks of chunkSegments video segments which are
+    encoded in parallel with the same settings and GOP length, then
+    concatenates the encoded chunks by stream copy into the output file of
+    the trip. See processVideosBasic for the parameters.
+    """
+    fTime = getTitleTime(vidList[0])
+    finalPath = getOutputPath(mTime, fTime)
+    if not shouldWriteOutput(finalPath):
+        print("Skipping %s, the file already exists." % finalPath)
+        return {"inputs": vidList, "output": finalPath, "final": finalPath,
+                "encoded": False, "stats": {}, "error": None}
+    n = int(chunkSegments)
+    chunks = [vidList[i:i+n] for i in range(0, len(vidList), n)]
+    chunkPaths = ["%s.chunk%03i.mp4" % (finalPath[:-4], i) for i in range(len(chunks))]
+    for chunkPath in chunkPaths:
+        # Remove chunks left behind by an interrupted run
+        if os.path.isfile(chunkPath):
+            os.remove(chunkPath)
+
+    # Use the same keyframe interval in every chunk, each chunk starts with
+    # a keyframe since it is a separate encode.
+    params = dict(params or getEncodeParams())
+    frameRate = getProbe(vidList[0])["frameRate"] or 30.0
+    params["extraArgs"] = ['-g', str(int(round(10 * frameRate)))]
+
+    def encodeChunk(i):
+        return processVideosBasic(chunks[i], mTime, fTime, params=params,
+                                  outputPath=chunkPaths[i])
+
+    # The number of concurrent FFmpeg processes is limited by encodeSlots
+    pool = ThreadPool(len(chunks))
     try:
-        os.remove("vidList.txt")
-    except:
-        pass
+        chunkResults = pool.map(encodeChunk, range(len(chunks)), chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    if all(r["encoded"] for r in chunkResults):
+        params = {"codec": "copy", "preset": None, "crf": None,
+                  "decimate": params.get("decimate")}
+        result = processVideosBasic(chunkPaths, mTime, fTime, params=params,
+                                    sources=vidList)
+        # Account for the encoding time of the chunks, not just the stitching
+        result["stats"]["wallSeconds"] = (result["stats"].get("wallSeconds", 0.0) +
+            sum(r["stats"].get("wallSeconds", 0.0) for r in chunkResults))
+        # The stitching does not decode anything, so the errors of decoding
+        # the video segments are only reported by the chunks
+        errors = [result["stats"].get("errors")] + [r["stats"].get("errors") for r in chunkResults]
+        result["stats"]["errors"] = "\n".join(e for e in errors if e)
+    else:
+        errors = [r["error"] for r in chunkResults if r["error"]]
+        result = {"inputs": vidList, "output": finalPath, "final": finalPath,
+                  "encoded": False, "stats": {},
+                  "error": errors[0] if errors else None}
 
+    for chunkPath in chunkPaths:
+        if os.path.isfile(chunkPath):
+            os.remove(chunkPath)
+    return result
 
-def processVideosComplex(vidList, mTime):
+
+def processVideosComplex(vidList, mTime, params=None):
+    """
+    Concatenates and re-encodes video segments with different formats using
+    the concat filter. See processVideosBasic for the parameters.
+    """
+    if params is None:
+        params = getEncodeParams()
+    codec, preset, crf = params["codec"], params["preset"], params["crf"]
     concat_cmd1 = ""
     concat_cmd2 = ""
     concat_cmd3 = ""
     n = 0
+    # Without a user-specified resolution, scale every segment to the
+    # resolution of the first segment so the concat filter accepts them.
+    if res is None:
+        scaleRes = getResolution(vidList[0]).replace("x", ":")
+    else:
+        scaleRes = res
+    decimation = "mpdecimate," if params.get("decimate") else ""
     for vid in vidList:
-        concat_cmd1 = concat_cmd1 + '-i "%s" '%vid
-        if res is None and videoFilters is None:
-            concat_cmd2 = ""
-        elif videoFilters is None:
-            concat_cmd2 = concat_cmd2 + "[%i:v]scale=%s:flags=%s[v%i]; "%(n, res, downscaler, n)
-        elif res is None:
-            concat_cmd2 = concat_cmd2 + "[%i:v]%s[v%i]; "%(n, videoFilters, n)
+        concat_cmd1 = concat_cmd1 + '-i "%s" '%getInputPath(vid)
+        if videoFilters is None:
+            concat_cmd2 = concat_cmd2 + "[%i:v]%sscale=%s:flags=%s,setsar=1[v%i]; "%(n, decimation, scaleRes, downscaler, n)
         else:
-            concat_cmd2 = concat_cmd2 + "[%i:v]%s,scale=%s:flags=%s[v%i]; "%(n, videoFilters, res, downscaler, n)
+            concat_cmd2 = concat_cmd2 + "[%i:v]%s%s,scale=%s:flags=%s,setsar=1[v%i]; "%(n, decimation, videoFilters, scaleRes, downscaler, n)
         concat_cmd3 = concat_cmd3 + "[v%i][%i:a]"%(n, n)
         n+=1
     concat_cmd = concat_cmd1 + '-filter_complex "'  + concat_cmd2 + concat_cmd3 + 'concat=n=%i:v=1:a=1[v][a]" -map [v] -map [a] '%n
     fTime = getTitleTime(vidList[0])
-    outputPath = "%s/%s_%s_trip.mp4" % (outputDir, mTime, fTime)
-    localmtime = getLocalmtime(vidList[0])
+    finalPath = getOutputPath(mTime, fTime)
+    if params.get("proxy"):
+        finalPath = getProxyPath(finalPath)
+    outputPath = getTempPath(finalPath)
+    creationTime = getUTCmtime(vidList[0])
     if codec == "copy":
-        raise RuntimeError("'Stream copy is not possible when concatenating different resolution videos.")
+        raise RuntimeError("Stream copy is not possible when concatenating different resolution videos, use processTrip to split the trip into parts.")
 
     elif (codec == "libx264") or (codec == "libx265"):
         cmd = [ffmpegPath, '-hide_banner'] + shlex.split(concat_cmd) + \
-              ['-metadata', 'creation_time=%s' % str(localmtime),
+              ['-metadata', 'creation_time=%s' % creationTime,
                '-metadata', 'artist="%s"' % author,
                '-metadata', 'author="%s"' % author,
                '-metadata', 'album_author="%s"' % author,
@@ -426,114 +2290,319 @@ def processVideosComplex(vidList, mTime):
         raise ValueError(
             "User-specified codec, %s, is not valid." % codec)
 
-    if overwriteExistingVideo:
-        cmd.append("-y")
-    elif overwriteExistingVideo is False:
-        cmd.append("-n")
-    else:
-        # Otherwise, ffmpeg was ask user at command line each time
-        pass
-
-    atime = os.path.getatime(vidList[0])
-    mtime = os.path.getmtime(vidList[0])
-    encodeRetCode = callFFmpeg(cmd)
-    if encodeRetCode and (encodeRetCode != -1):
-        warn("ERROR: Encoding process returned a %s error code."%encodeRetCode)
-        errorVideos.append(outputPath)
-    if  encodeRetCode==0:
-        if checkVideoFile(outputPath):
-            warn("ERROR: Integrity check of %s failed!"%outputPath)
-            errorVideos.append(outputPath)
-        else:
-            pass
-        os.utime(outputPath, (atime, mtime))
-        changeFileCreationTime(outputPath, os.path.getctime(vidList[0]))
+    if decimation:
+        cmd[-1:-1] = ['-vsync', 'vfr']
 
+    result = encodeVideo(cmd, vidList, outputPath, finalPath)
+    if decimation and "expected" in result:
+        result["expected"]["frames"] = None
 
+    return result
 
 
-"""
-MAIN CODE IS BELOW
-"""
+def getChildCpuSeconds():
+    """
+    Returns the CPU time used by FFmpeg and the other child processes so far
+    (Unix only).
+    """
+    times = os.times()
+    return times[2] + times[3]
 
-if __name__ == "__main__":
-    print("\n\nYiDashCamConcatenate Copyright (C) 2019 David John Neiferd\n")
-    print("This program is distributed in the hope that it will be useful,")
-    print("but WITHOUT ANY WARRANTY; without even the implied warranty of")
-    print("MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the")
-    print("GNU General Public License for more details.")
-    print("This is free software, and you are welcome to redistribute it")
-    print("under certain conditions.")
-    print("See the README.md and LICENSE files for details.\n\n")
+def writeRunReport(results, runStart, cpuStart=0.0, streamSeconds=None):
+    """
+    Prints the throughput of the run and writes it together with the
+    statistics of every job to a JSON report in outputDir.
 
-    sleep(5)
-
-    # Some defaults if not defined in settings.cfg
-    maxDiff = 5
-    codec = "copy"
-    preset = "medium"
-    crf = "23"
-    res = None
-    downscaler = "bicubic"
-    sdCardRoot = None
-    outputDir = None
-    ffmpegPath = "ffmpeg"
-    camName = ""
-    camModel = ""
-    camSerialNum = ""
-    comment = ""
-    copyright = ""
-    combineMovieAndEMR = False
-    optimizePhotos = False
-    resolution = None
-    CRF = 23
-    speed = "medium"
-    videoCodec = "copy"
-    videoFilters = None
-    audioCodec = "aac"
-    audioBitrate = "192k"
-    jpegoptimPath = None
-    overwriteExistingVideo = None
+    Parameters
+    ----------
+    results :   list of dict
+        Results of all jobs of the run, as returned by processVideos.
+    runStart    :   float
+        Time at which the run started, as returned by time.time().
+    cpuStart    :   float, optional
+        CPU time of the child processes when the run started, as returned by
+        getChildCpuSeconds.
+    streamSeconds   :   dict, optional
+        Run time of each stream (Movie, EMR and Photo) in seconds.
 
-    # Get the Configuration File Path
-    if len(sys.argv)>1:
-        config_file = sys.argv[1]
+    Returns
+    -------
+    reportPath  :   str
+        Path to the written report.
+    """
+    wallSeconds = max(time() - runStart, 1e-6)
+    jobs = []
+    for result in results:
+        stats = result.get("stats", {})
+        progress = stats.get("progress", {})
+        jobs.append({"output": result["output"],
+                     "error": result["error"],
+                     "segments": len(result["inputs"]),
+                     "inputBytes": result.get("inputBytes", 0),
+                     "outputBytes": int(progress.get("total_size", 0) or 0),
+                     "mediaSeconds": getProgressTime(progress),
+                     "encodeSeconds": stats.get("wallSeconds", 0.0),
+                     "verifySeconds": result.get("verifySeconds", 0.0),
+                     "costKey": result.get("costKey"),
+                     "megapixels": result.get("megapixels"),
+                     "predictedSeconds": result.get("predictedSeconds"),
+                     "crf": result.get("crf"),
+                     "preset": result.get("preset"),
+                     "predictedBitrate": result.get("predictedBitrate"),
+                     "fps": progress.get("fps"),
+                     "speed": progress.get("speed"),
+                     "bitrate": progress.get("bitrate")})
+
+    inputBytes = sum(job["inputBytes"] for job in jobs)
+    mediaSeconds = sum(job["mediaSeconds"] for job in jobs)
+    # CPU time used by FFmpeg and the other child processes, close to the
+    # available CPU time when the run was CPU bound (Unix only)
+    cpuSeconds = getChildCpuSeconds() - cpuStart
+    summary = {"wallSeconds": wallSeconds,
+               "jobs": len(jobs),
+               "errors": len([job for job in jobs if job["error"]]),
+               "inputBytes": inputBytes,
+               "throughputMBps": inputBytes / 1e6 / wallSeconds,
+               "mediaSeconds": mediaSeconds,
+               "realtimeFactor": mediaSeconds / wallSeconds,
+               "encodeSeconds": sum(job["encodeSeconds"] for job in jobs),
+               "verifySeconds": sum(job["verifySeconds"] for job in jobs),
+               "predictedSeconds": sum(job["predictedSeconds"] or 0.0 for job in jobs),
+               "childCpuSeconds": cpuSeconds,
+               "cpuUtilization": cpuSeconds / (wallSeconds * cpu_count()),
+               "streamSeconds": streamSeconds or {}}
+
+    print("\nProcessed %i video(s) in %s: %.1f MB/s, %.1fx realtime, %.0f%% CPU"
+          % (summary["jobs"], formatDuration(wallSeconds),
+             summary["throughputMBps"], summary["realtimeFactor"],
+             100.0 * summary["cpuUtilization"]))
+    if summary["predictedSeconds"] > 0:
+        print("Encoding took %s, predicted %s"
+              % (formatDuration(summary["encodeSeconds"]),
+                 formatDuration(summary["predictedSeconds"])))
+
+    reportPath = os.path.join(outputDir, "ydcc_report_%s.json"
+                              % datetime.now().strftime("%Y%m%d_%H%M%S"))
+    with open(reportPath, 'w') as reportFile:
+        json.dump({"summary": summary, "jobs": jobs}, reportFile, indent=2)
+    return reportPath
+
+
+
+
+ffmpegCachePath = os.path.join(os.path.expanduser("~"), ".ydcc_ffmpeg_cache.json")
+
+def findExecutable(path):
+    """
+    Returns the path to the executable at path, which is looked up in the
+    directories of the PATH environment variable if it is just a name, or
+    None if it does not exist.
+    """
+    if os.path.dirname(path):
+        candidates = [path]
     else:
-        if getattr(sys, 'frozen', False):
-            application_path = os.path.dirname(sys.executable)
-        elif __file__:
-            application_path = os.path.dirname(os.path.abspath(__file__))
-        config_file = application_path + "/settings.cfg"
+        candidates = [os.path.join(d, path) for d in os.environ.get("PATH", "").split(os.pathsep)]
+    for candidate in candidates:
+        for name in (candidate, candidate + ".exe"):
+            if os.path.isfile(name):
+                return name
+    return None
+
+def getFFmpegCapabilities():
+    """
+    Returns the version and the encoders of the FFmpeg executable at
+    ffmpegPath. They are cached in ffmpegCachePath for the executable's path,
+    size and modification time, so FFmpeg is only queried again after it was
+    replaced.
 
-    # Load the Configuration File
-    for line in open(config_file, 'r'):
-        exec (line)
+    Returns
+    -------
+    capabilities    :   dict
+        "version", the first line of "ffmpeg -version", and "encoders", the
+        names of all encoders.
+    """
+    executable = findExecutable(ffmpegPath)
+    if executable is None:
+        raise ValueError("Could not find '%s'. Did you set the correct path to ffmpeg?" % ffmpegPath)
+    st = os.stat(executable)
+    key = "%s|%i|%i" % (os.path.abspath(executable), st.st_size, int(st.st_mtime))
+    try:
+        with open(ffmpegCachePath, 'r') as cacheFile:
+            cache = json.load(cacheFile)
+    except (IOError, OSError, ValueError):
+        cache = {}
+    if key in cache:
+        return cache[key]
+
+    try:
+        version = check_output([executable, '-hide_banner', '-version']).decode("utf-8", "replace")
+        encoderList = check_output([executable, '-hide_banner', '-encoders']).decode("utf-8", "replace")
+    except (OSError, CalledProcessError):
+        raise ValueError("Could not successfully execute '%s -version'. Did you set the correct path to ffmpeg?" % ffmpegPath)
+    # The encoders are listed after a " ------" line as " V....D name  description"
+    encoders = []
+    lines = encoderList.splitlines()
+    for i, line in enumerate(lines):
+        if line.strip().startswith("------"):
+            encoders = [l.split()[1] for l in lines[i+1:] if len(l.split()) > 1]
+            break
+    capabilities = {"version": version.splitlines()[0] if version else "",
+                    "encoders": encoders}
+
+    cache[key] = capabilities
+    try:
+        with open(ffmpegCachePath, 'w') as cacheFile:
+            json.dump(cache, cacheFile)
+    except (IOError, OSError):
+        pass
+    return capabilities
+
+
+# Settings and their defaults if not defined in settings.cfg
+defaultSettings = {"maxDiff": 5,
+                   "sdCardRoot": None,
+                   "outputDir": None,
+                   "watchDir": None,
+                   "watchInterval": None,
+                   "ffmpegPath": "ffmpeg",
+                   "camName": "",
+                   "camModel": "",
+                   "camSerialNum": "",
+                   "comment": "",
+                   "copyright": "",
+                   "combineMovieAndEMR": False,
+                   "optimizePhotos": False,
+                   "resolution": None,
+                   "CRF": 23,
+                   "speed": "medium",
+                   "videoCodec": "copy",
+                   "downscaler": "bicubic",
+                   "videoFilters": None,
+                   "audioCodec": "aac",
+                   "audioBitrate": "192k",
+                   "jpegoptimPath": None,
+                   "overwriteExistingVideo": None,
+                   "maxParallelJobs": 1,
+                   "ffmpegThreads": None,
+                   "incrementalArchive": True,
+                   "verifyLevel": "decode",
+                   "photoJobs": 4,
+                   "twoStageEncode": False,
+                   "proxyCodec": "copy",
+                   "chunkSegments": None,
+                   "stagingDir": None,
+                   "stagingSizeGB": 10,
+                   "cameraTimezone": None,
+                   "idleSegments": None,
+                   "idleNoise": -35,
+                   "targetBitrate": None,
+                   "encodeBudget": None,
+                   "verifySamples": 8}
+
+# Settings holding text, such as names and paths, which may look like numbers
+stringSettings = set([name for name, value in defaultSettings.items()
+                      if isinstance(value, str)] +
+                     ["sdCardRoot", "outputDir", "watchDir", "jpegoptimPath",
+                      "stagingDir", "resolution", "videoFilters",
+                      "cameraTimezone", "idleSegments"])
+
+def parseConfigFile(configFile):
+    """
+    Parses a configuration file without executing it. Every line which is not
+    blank or a comment must assign a Python literal, such as a string, number,
+    True, False or None, to the name of a setting.
+
+    Returns
+    -------
+    settings    :   dict
+        Values of the settings in the file.
+    """
+    settings = {}
+    with open(configFile, 'r') as f:
+        for lineNumber, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                node = ast.parse(line).body[0]
+                if (not isinstance(node, ast.Assign) or len(node.targets) != 1 or
+                        not isinstance(node.targets[0], ast.Name)):
+                    raise ValueError("not an assignment")
+                settings[node.targets[0].id] = ast.literal_eval(node.value)
+            except (SyntaxError, ValueError) as e:
+                raise ValueError("%s, line %i: could not parse '%s' (%s)"
+                                 % (configFile, lineNumber, line, e))
+            if node.targets[0].id not in defaultSettings:
+                warn("%s, line %i: unknown setting '%s'"
+                     % (configFile, lineNumber, node.targets[0].id))
+    return settings
+
+def parseValue(text):
+    """
+    Returns the Python literal in text, or text itself if it is not a literal,
+    so strings can be passed on the command line without quotes.
+    """
+    try:
+        return ast.literal_eval(text)
+    except (SyntaxError, ValueError):
+        return text
+
+def parseSetting(name):
+    """
+    Returns the function parsing the command line value of the setting name.
+    The values of stringSettings are kept as text unless they are None or a
+    quoted string, so e.g. --camSerialNum 123456 is not read as a number.
+    """
+    def parse(text):
+        value = parseValue(text)
+        if name in stringSettings and value is not None and not isinstance(value, str):
+            return text
+        return value
+    return parse
+
+def loadSettings(configFiles, overrides=None):
+    """
+    Sets all settings to their defaults, then loads them from configFiles in
+    order, so later files override earlier ones. The settings in the dict
+    overrides, such as the ones given on the command line, take precedence
+    over all files.
+    """
+    settings = dict(defaultSettings)
+    for configFile in configFiles:
+        settings.update(parseConfigFile(configFile))
+    settings.update(overrides or {})
+    for name in stringSettings:
+        # e.g. camSerialNum = 123456 in a configuration file
+        if isinstance(settings[name], (int, float)):
+            settings[name] = str(settings[name])
+    globals().update(settings)
+
+    global codec, preset, crf, res, author, downscaler, videoFilters, cameraTz
+    # Raises an error early on an unknown timezone name
+    cameraTz = None if cameraTimezone is None else timezone(cameraTimezone)
+    utcTimes.clear()
     codec = videoCodec
     preset = speed
     crf = CRF
     res = resolution
     author = camName + " " + camModel + " " + camSerialNum
 
-    if sdCardRoot is None:
-        raise ValueError("sdCardRoot was not specified in settings.cfg!")
-
-    if outputDir is None:
-        raise ValueError("outputDir was not specified in settings.cfg!")
-
-    try:
-        check_output([ffmpegPath, '-h'])
-    except:
-        raise ValueError("Could not successfully execute '%s -h'. Did you set the correct path to ffmpeg?" % ffmpegPath)
-
     if codec == "copy":
-        print(
-            "\nvideoCodec has been set to 'copy'.\n'CRF', 'speed', 'resolution', 'videoFilters', and 'downscaler' options will be ignored.\n")
         preset = None
         crf = None
         res = None
         downscaler = None
         videoFilters = None
 
+
+def printSettings():
+    """
+    Prints the loaded settings.
+    """
+    if codec == "copy":
+        print(
+            "\nvideoCodec has been set to 'copy'.\n'CRF', 'speed', 'resolution', 'videoFilters', and 'downscaler' options will be ignored.\n")
+
     print("Loaded Settings\n---------------------------------------------------")
 
     print("ffmpegPath = %s" % ffmpegPath)
@@ -545,7 +2614,9 @@ if __name__ == "__main__":
     print("copyright = %s\n" % copyright)
 
     print("sdCardRoot = %s" % sdCardRoot)
-    print("outputDir = %s\n" % outputDir)
+    print("outputDir = %s" % outputDir)
+    print("watchDir = %s" % watchDir)
+    print("watchInterval = %s\n" % watchInterval)
 
     print("maxDiff = %s" % maxDiff)
     print("videoCodec = %s" % codec)
@@ -558,44 +2629,304 @@ if __name__ == "__main__":
     print("audioBitrate = %s" % audioBitrate)
     print("combineMovieAndEMR = %s" % combineMovieAndEMR)
     print("optimizePhotos = %s" % optimizePhotos)
-    print("overwriteExistingVideo = %s\n"%overwriteExistingVideo)
+    print("overwriteExistingVideo = %s"%overwriteExistingVideo)
+    print("maxParallelJobs = %s" % maxParallelJobs)
+    print("ffmpegThreads = %s" % ffmpegThreads)
+    print("incrementalArchive = %s" % incrementalArchive)
+    print("verifyLevel = %s" % verifyLevel)
+    print("verifySamples = %s" % verifySamples)
+    print("photoJobs = %s" % photoJobs)
+    print("twoStageEncode = %s" % twoStageEncode)
+    print("proxyCodec = %s" % proxyCodec)
+    print("chunkSegments = %s" % chunkSegments)
+    print("stagingDir = %s" % stagingDir)
+    print("stagingSizeGB = %s" % stagingSizeGB)
+    print("cameraTimezone = %s" % cameraTimezone)
+    print("idleSegments = %s" % idleSegments)
+    print("idleNoise = %s" % idleNoise)
+    print("targetBitrate = %s" % targetBitrate)
+    print("encodeBudget = %s\n" % encodeBudget)
 
     print("---------------------------------------------------")
 
-    ans = raw_input(
-        "If the above settings look correct and you agree to the terms of use type yes to begin or no to cancel...   ")
-    if ans.lower() != "yes":
-        raise ValueError("User did not type yes, canceling operation.")
+
+def runPipeline(streams):
+    """
+    Runs the streams of a pipeline, tuples of (name, func, files), one after
+    another and returns their results and run times.
+    """
+    results = []
+    seconds = []
+    for name, func, files in streams:
+        start = time()
+        results += func(files) or []
+        seconds.append((name, time() - start))
+    return results, seconds
+
+def runPipelines(pipelines):
+    """
+    Runs pipelines, lists of streams as taken by runPipeline, concurrently.
+
+    Returns
+    -------
+    results :   list of dict
+        Results of all output videos, as returned by processVideos.
+    streamSeconds   :   dict
+        Run time of each stream in seconds.
+    """
+    pool = ThreadPool(len(pipelines))
+    try:
+        pending = [pool.apply_async(runPipeline, (streams,)) for streams in pipelines]
+        outcomes = [p.get(waitTimeout) for p in pending]
+    except BaseException:
+        # Only this thread receives Ctrl+C, stop the jobs of the pipelines
+        stopEvent.set()
+        raise
+    finally:
+        pool.close()
+        pool.join()
+    results = [result for outcome in outcomes for result in outcome[0]]
+    streamTimes = [pair for outcome in outcomes for pair in outcome[1]]
+    print("\n" + ", ".join("%s took %s" % (name, formatDuration(seconds))
+                           for name, seconds in streamTimes))
+    return results, dict(streamTimes)
+
+
+def archiveCard(cardRoot):
+    """
+    Archives the videos and photos of the SD card mounted at cardRoot to
+    outputDir.
+
+    Returns
+    -------
+    results :   list of dict
+        Results of all output videos, as returned by processVideos.
+    """
+    # The state of a previous card does not apply to this card
+    with probeCacheLock:
+        probeCache.clear()
+    with manifestLock:
+        manifest.clear()
+    with journalLock:
+        journal.clear()
+    with promptLock:
+        overwriteDecisions.clear()
+    with statCacheLock:
+        statCache.clear()
+    with cardIndexLock:
+        cardIndex.clear()
+
+    loadProbeCache()
+    loadEncodeRates()
+    if incrementalArchive:
+        loadManifest()
+    loadJournal()
+
+    runStart = time()
+    cpuStart = getChildCpuSeconds()
 
     dashCamVidRelativePath = "/Movie"
     dashCamEmrRelativePath = "/EMR"
     dashCamPhotoRelativePath = "/Photo"
 
-    vidList = abslistdir(sdCardRoot+dashCamVidRelativePath)
-    fullVidList = [vid for vid in vidList if (vid.endswith(".MP4") or vid.endswith(".mp4")) and "_s" not in vid]
-    fullVidList.sort()
-
-    emrList = abslistdir(sdCardRoot+dashCamEmrRelativePath)
-    fullEmrList = [vid for vid in emrList if (vid.endswith(".MP4") or vid.endswith(".mp4")) and "_s" not in vid]
-    fullEmrList.sort()
+    fullVidList = listSegments(cardRoot+dashCamVidRelativePath)
+    fullEmrList = listSegments(cardRoot+dashCamEmrRelativePath)
 
-    picList = abslistdir(sdCardRoot + dashCamPhotoRelativePath)
+    picList = abslistdir(cardRoot + dashCamPhotoRelativePath)
 
+    # The videos are encoded while the photos are copied. Movie and EMR share
+    # the maxParallelJobs budget and may produce the same output files, so
+    # they are processed one after another.
     if combineMovieAndEMR:
-        baselist = [os.path.basename(vid) for vid in (fullVidList+fullEmrList)]
-        ind = pyargsort(baselist)
-        fullBase = (fullVidList+fullEmrList)
-        fullList = [fullBase[i] for i in ind]
-        processVideos(fullList)
+        fullList = sorted(fullVidList + fullEmrList,
+                          key=lambda vid: cardIndex[vid].name)
+        videoStreams = [("Movie+EMR", processVideos, fullList)]
     else:
-        processVideos(fullVidList)
-        processVideos(fullEmrList)
+        videoStreams = [("Movie", processVideos, fullVidList),
+                        ("EMR", processVideos, fullEmrList)]
+    results, streamSeconds = runPipelines([videoStreams,
+                                           [("Photo", processPhotos, picList)]])
 
-    processPhotos(picList)
+    writeRunReport(results, runStart, cpuStart, streamSeconds)
+    clearJournal()
 
-    errorVideos = set(errorVideos)
+    errorVideos = set(r["output"] for r in results if r["error"])
     if len(errorVideos)>0:
         warn("Encounter errors on the following videos: %s"%errorVideos)
+    return results
+
+
+cardConfigName = "ydcc.cfg"
+cardSerials = {}
+
+def findCards(directory):
+    """
+    Returns the SD card roots in directory, which are the subdirectories (or
+    links to mount points) containing a "Movie", "EMR" or "Photo" directory.
+    """
+    cards = []
+    for name in sorted(os.listdir(directory)):
+        cardRoot = os.path.join(directory, name)
+        if any(os.path.isdir(os.path.join(cardRoot, d)) for d in ("Movie", "EMR", "Photo")):
+            cards.append(cardRoot)
+    return cards
+
+def getCardSignature(cardRoot):
+    """
+    Returns the number of files and the last file name of each directory of
+    an SD card, which changes whenever the camera records to the card.
+    """
+    signature = []
+    for d in ("Movie", "EMR", "Photo"):
+        path = os.path.join(cardRoot, d)
+        if os.path.isdir(path):
+            names = os.listdir(path)
+            signature.append([d, len(names), max(names) if names else None])
+    return signature
+
+def loadCardSettings(configFile, cardRoot, overrides=None):
+    """
+    Loads the settings for the SD card mounted at cardRoot, which are the
+    settings of configFile overridden by the optional cardConfigName file on
+    the card and then by overrides. The output of the card goes to a
+    directory in outputDir named after camSerialNum, or after the card if
+    camSerialNum is not set or already used by another card.
+    """
+    configFiles = [configFile]
+    cardConfig = os.path.join(cardRoot, cardConfigName)
+    if os.path.isfile(cardConfig):
+        configFiles.append(cardConfig)
+    loadSettings(configFiles, overrides)
+
+    global sdCardRoot, outputDir, overwriteExistingVideo
+    sdCardRoot = cardRoot
+    cardName = os.path.basename(os.path.normpath(cardRoot))
+    serial = camSerialNum.strip()
+    if serial and cardSerials.setdefault(serial, cardRoot) != cardRoot:
+        # Trips of two cameras starting at the same time would get the same
+        # output name
+        warn("camSerialNum %s is already used by card %s, the output of card %s goes to %s instead. "
+             "Set camSerialNum in the %s file of each card."
+             % (serial, cardSerials[serial], cardRoot, cardName, cardConfigName))
+        serial = ""
+    outputDir = os.path.join(outputDir, serial or cardName)
+    if not os.path.isdir(outputDir):
+        os.makedirs(outputDir)
+    # Nobody is there to answer the overwrite prompt
+    if overwriteExistingVideo is None:
+        overwriteExistingVideo = False
+
+def watchCards(configFile, overrides=None):
+    """
+    Archives every SD card in watchDir, one after another. All cards share
+    the same maxParallelJobs budget of FFmpeg processes. If watchInterval is
+    None, returns after all cards were archived once. Otherwise keeps looking
+    for new cards every watchInterval seconds and archives a card again when
+    the camera recorded to it since it was last archived.
+    """
+    directory, interval = watchDir, watchInterval
+    # Created now, so the budget of configFile applies to all cards
+    getEncodeSlots()
+    archived = {}
+    while True:
+        for cardRoot in findCards(directory):
+            signature = getCardSignature(cardRoot)
+            if archived.get(cardRoot) == signature:
+                continue
+            try:
+                loadCardSettings(configFile, cardRoot, overrides)
+                print("\nArchiving card %s to %s" % (cardRoot, outputDir))
+                archiveCard(cardRoot)
+            except Exception as e:
+                # Try again on the next pass
+                warn("Could not archive card %s: %s" % (cardRoot, e))
+                continue
+            archived[cardRoot] = signature
+        if interval is None:
+            break
+        sleep(interval)
+
+
+def parseArguments(argv=None):
+    """
+    Parses the command line arguments. Every setting can be given as an
+    option named after it, which overrides the configuration file.
+    """
+    parser = argparse.ArgumentParser(
+        description="Concatenates the video segments recorded by a Yi Dash Cam into one video per trip.")
+    parser.add_argument("configFile", nargs="?", default=None,
+                        help="Path to the configuration file, defaults to settings.cfg next to the program.")
+    parser.add_argument("-y", "--yes", action="store_true",
+                        help="Start without asking for confirmation.")
+    parser.add_argument("--batch", action="store_true",
+                        help="Never ask anything: implies --yes and skips existing videos if overwriteExistingVideo is None.")
+    group = parser.add_argument_group(
+        "settings", "Override the settings of the configuration file, for example "
+                    "--videoCodec libx264 --resolution None. Values are read as Python literals, except that names and paths are always text.")
+    for name in sorted(defaultSettings):
+        group.add_argument("--" + name, type=parseSetting(name), default=argparse.SUPPRESS,
+                           metavar="VALUE")
+    return parser.parse_args(argv)
+
+
+"""
+MAIN CODE IS BELOW
+"""
+
+if __name__ == "__main__":
+    print("\n\nYiDashCamConcatenate Copyright (C) 2019 David John Neiferd\n")
+    print("This program is distributed in the hope that it will be useful,")
+    print("but WITHOUT ANY WARRANTY; without even the implied warranty of")
+    print("MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the")
+    print("GNU General Public License for more details.")
+    print("This is free software, and you are welcome to redistribute it")
+    print("under certain conditions.")
+    print("See the README.md and LICENSE files for details.\n\n")
+
+    args = parseArguments()
+    overrides = dict((name, getattr(args, name)) for name in defaultSettings
+                     if hasattr(args, name))
+
+    # Get the Configuration File Path
+    if args.configFile is not None:
+        config_file = args.configFile
+    else:
+        if getattr(sys, 'frozen', False):
+            application_path = os.path.dirname(sys.executable)
+        elif __file__:
+            application_path = os.path.dirname(os.path.abspath(__file__))
+        config_file = application_path + "/settings.cfg"
+
+    # Load the Configuration File
+    loadSettings([config_file], overrides)
+    if args.batch and overwriteExistingVideo is None:
+        overwriteExistingVideo = False
+
+    if sdCardRoot is None and watchDir is None:
+        raise ValueError("sdCardRoot was not specified in settings.cfg!")
+
+    if outputDir is None:
+        raise ValueError("outputDir was not specified in settings.cfg!")
+
+    capabilities = getFFmpegCapabilities()
+    # The audio is only encoded along with the video
+    for encoder in ([codec, audioCodec] if codec != "copy" else []):
+        if encoder not in capabilities["encoders"]:
+            warn("%s does not support the encoder '%s'." % (capabilities["version"], encoder))
+
+    printSettings()
+
+    if watchDir is not None:
+        # Batch mode, runs without asking for confirmation
+        watchCards(config_file, overrides)
+    else:
+        if not (args.yes or args.batch):
+            ans = raw_input(
+                "If the above settings look correct and you agree to the terms of use type yes to begin or no to cancel...   ")
+            if ans.lower() != "yes":
+                raise ValueError("User did not type yes, canceling operation.")
+
+        archiveCard(sdCardRoot)
 
     print("\nAll done!\n")
 
@@ -608,4 +2939,6 @@ if __name__ == "__main__":
     print("under certain conditions.")
     print("See the README.md and LICENSE files for details.\n\n")
 
-    sleep(6)
\ No newline at end of file
+    if not (args.yes or args.batch or watchDir is not None):
+        # Leave time to read the output before the console window closes
+        sleep(6)
\ No newline at end of file
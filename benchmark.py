@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+"""
+YiDashCamConcatenate (YDCC) benchmark suite
+
+Generates synthetic Yi Dash Cam SD cards (Movie, EMR and Photo directories
+with YYYY_MMDD_HHMMSS named segments) using FFmpeg's lavfi test sources and
+times the stages of DashCamArchive.py on them: directory scanning, trip
+grouping, probing, stream copy concatenation, transcoding and verification.
+
+Usage: python benchmark.py [--sizes 10,100,1000,5000] [--output results.json]
+                           [--compare previous_results.json]
+
+Copyright (C) 2019  David John Neiferd
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Main repository is located at: https://github.com/JohnDN90/YiDashCamConcatenate
+"""
+
+import os
+import sys
+import json
+import random
+import argparse
+import platform
+import tempfile
+from time import time
+from shutil import copyfile, rmtree
+from datetime import datetime, timedelta
+from subprocess import check_call, check_output
+
+import DashCamArchive as dca
+
+# Settings of DashCamArchive used by the benchmark, normally loaded from
+# settings.cfg by the main code.
+SETTINGS = {"maxDiff": 15,
+            "codec": "copy",
+            "preset": None,
+            "crf": None,
+            "res": None,
+            "downscaler": "bicubic",
+            "videoFilters": None,
+            "audioCodec": "aac",
+            "audioBitrate": "128k",
+            "author": "YDCC Benchmark",
+            "comment": "",
+            "copyright": "",
+            "ffmpegPath": "ffmpeg",
+            "overwriteExistingVideo": True,
+            "maxParallelJobs": 1,
+            "ffmpegThreads": None,
+            "incrementalArchive": False,
+            "verifyLevel": "probe",
+            "optimizePhotos": False,
+            "jpegoptimPath": None,
+            "photoJobs": 4,
+            "twoStageEncode": False,
+            "proxyCodec": "copy",
+            "chunkSegments": None,
+            "stagingDir": None,
+            "stagingSizeGB": 10,
+            "cameraTimezone": None,
+            "idleSegments": None,
+            "idleNoise": -35,
+            "targetBitrate": None,
+            "encodeBudget": None,
+            "verifySamples": 8}
+
+NAME_FORMAT = "%Y_%m%d_%H%M%S"
+SEGMENT_SECONDS = 60
+
+
+class Quiet(object):
+    """
+    Context manager which discards the output printed by DashCamArchive.
+    """
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def configure(**settings):
+    """
+    Sets the settings of DashCamArchive to SETTINGS updated with settings.
+    """
+    values = dict(SETTINGS)
+    values.update(settings)
+    for name, value in values.items():
+        setattr(dca, name, value)
+
+
+def makeTemplate(path, size, duration, fps):
+    """
+    Creates a synthetic video segment with a test pattern and a sine tone.
+    """
+    cmd = [SETTINGS["ffmpegPath"], '-hide_banner', '-v', 'error', '-y',
+           '-f', 'lavfi', '-i', 'testsrc2=size=%s:rate=%s' % (size, fps),
+           '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=48000',
+           '-t', str(duration), '-c:v', 'libx264', '-preset', 'ultrafast',
+           '-g', str(fps), '-pix_fmt', 'yuv420p', '-c:a', 'aac', '-shortest',
+           path]
+    check_call(cmd)
+
+
+def makePhoto(path):
+    cmd = [SETTINGS["ffmpegPath"], '-hide_banner', '-v', 'error', '-y',
+           '-f', 'lavfi', '-i', 'testsrc2=size=640x360', '-frames:v', '1',
+           path]
+    check_call(cmd)
+
+
+def linkFile(src, dst):
+    """
+    Hard links src to dst, falling back to copying where links are not
+    supported.
+    """
+    try:
+        os.link(src, dst)
+    except (OSError, AttributeError):
+        copyfile(src, dst)
+
+
+def makeCard(root, nSegments, templates, photo, seed=0, mixedFraction=0.1,
+             emrFraction=0.02):
+    """
+    Creates a synthetic SD card with nSegments video segments in the Movie
+    directory, grouped in trips of 1 to 200 segments. Some trips cross
+    midnight and a fraction of the trips changes resolution halfway through.
+    A fraction of the segments also gets an EMR copy and a photo.
+
+    Returns
+    -------
+    nTrips  :   int
+        Number of trips on the card.
+    """
+    rng = random.Random(seed)
+    for d in ("Movie", "EMR", "Photo"):
+        os.makedirs(os.path.join(root, d))
+
+    start = datetime(2019, 1, 15, 8, 0, 0)
+    nTrips = 0
+    n = 0
+    while n < nSegments:
+        length = min(rng.randint(1, 200), nSegments - n)
+        if nTrips % 5 == 2:
+            # Start every fifth trip shortly before midnight
+            start = start.replace(hour=23, minute=50)
+        mixed = rng.random() < mixedFraction
+        for i in range(length):
+            t = start + timedelta(seconds=SEGMENT_SECONDS * i)
+            name = t.strftime(NAME_FORMAT) + ".MP4"
+            template = templates[1] if (mixed and i >= length // 2) else templates[0]
+            linkFile(template, os.path.join(root, "Movie", name))
+            if rng.random() < emrFraction:
+                linkFile(template, os.path.join(root, "EMR", name))
+                linkFile(photo, os.path.join(root, "Photo", t.strftime(NAME_FORMAT) + ".JPG"))
+        n += length
+        nTrips += 1
+        start = start + timedelta(seconds=SEGMENT_SECONDS * length,
+                                  minutes=rng.randint(10, 600))
+    return nTrips
+
+
+def timeStage(func, repeat=1):
+    """
+    Returns the shortest run time of func in seconds over repeat runs.
+    """
+    best = None
+    for i in range(repeat):
+        start = time()
+        with Quiet():
+            func()
+        elapsed = time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def runSize(workDir, nSegments, templates, photo, args):
+    """
+    Runs all benchmark stages on a synthetic card with nSegments segments and
+    returns the results.
+    """
+    cardRoot = os.path.join(workDir, "card_%i" % nSegments)
+    outputDir = os.path.join(workDir, "out_%i" % nSegments)
+    for d in (cardRoot, outputDir):
+        if os.path.isdir(d):
+            rmtree(d)
+    os.makedirs(outputDir)
+    nTrips = makeCard(cardRoot, nSegments, templates, photo, seed=args.seed)
+    configure(outputDir=outputDir, maxParallelJobs=args.jobs)
+
+    results = []
+
+    def record(stage, seconds, segments=nSegments):
+        results.append({"stage": stage, "segments": segments, "trips": nTrips,
+                        "seconds": seconds,
+                        "secondsPerSegment": seconds / max(segments, 1)})
+        print("%-16s %6i segments %10.3f s" % (stage, segments, seconds))
+
+    movieDir = os.path.join(cardRoot, "Movie")
+    record("scan", timeStage(lambda: dca.listSegments(movieDir), args.repeat))
+    vlist = dca.listSegments(movieDir)
+    record("grouping", timeStage(lambda: dca.groupTrips(vlist), args.repeat))
+
+    dca.probeCache.clear()
+    record("probe_cold", timeStage(lambda: dca.probeVideos(vlist)))
+    record("probe_warm", timeStage(lambda: dca.probeVideos(vlist), args.repeat))
+
+    configure(outputDir=outputDir, maxParallelJobs=args.jobs, codec="copy")
+    copyResults = []
+    record("copy", timeStage(lambda: copyResults.extend(dca.processVideos(vlist))))
+
+    outputs = [(r["output"], r["inputs"]) for r in copyResults if not r["error"]]
+    for level in ("probe", "packet", "sampled", "decode"):
+        configure(outputDir=outputDir, verifyLevel=level)
+        record("verify_%s" % level, timeStage(
+            lambda: [dca.checkVideoFile(o, dca.getExpectedStats(i), level)
+                     for o, i in outputs]))
+
+    # Transcoding is slow, so only the trips within the first
+    # --transcode-max segments are transcoded.
+    tlist = vlist[:args.transcode_max]
+    configure(outputDir=outputDir, maxParallelJobs=args.jobs,
+              codec="libx264", preset="ultrafast", crf=23)
+    record("transcode", timeStage(lambda: dca.processVideos(tlist)), len(tlist))
+
+    if not args.keep:
+        rmtree(cardRoot)
+        rmtree(outputDir)
+    return results
+
+
+def getEnvironment():
+    ffmpegVersion = check_output([SETTINGS["ffmpegPath"], '-version'])
+    return {"date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": dca.cpu_count(),
+            "ffmpeg": ffmpegVersion.decode("utf-8").splitlines()[0]}
+
+
+def compareResults(results, previousPath):
+    """
+    Prints the ratio of the run times to those of a previous benchmark.
+    """
+    with open(previousPath, 'r') as f:
+        previous = json.load(f)["results"]
+    old = dict(((r["stage"], r["segments"]), r["seconds"]) for r in previous)
+    print("\n%-16s %8s %10s %10s %8s" % ("stage", "segments", "before", "after", "ratio"))
+    for r in results:
+        key = (r["stage"], r["segments"])
+        if key in old and old[key] > 0:
+            print("%-16s %8i %10.3f %10.3f %7.2fx" % (r["stage"], r["segments"],
+                  old[key], r["seconds"], r["seconds"] / old[key]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark DashCamArchive.py on synthetic SD cards.")
+    parser.add_argument("--sizes", default="10,100,1000,5000",
+                        help="Comma separated numbers of segments per card.")
+    parser.add_argument("--segment-duration", type=float, default=SEGMENT_SECONDS,
+                        help="Duration of each synthetic segment in seconds.")
+    parser.add_argument("--resolution", default="320x180",
+                        help="Resolution of the synthetic segments.")
+    parser.add_argument("--fps", type=int, default=10,
+                        help="Frame rate of the synthetic segments.")
+    parser.add_argument("--transcode-max", type=int, default=100,
+                        help="Maximum number of segments to transcode per card.")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="maxParallelJobs used for processing.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of repetitions of the fast stages.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", default=None,
+                        help="Directory for the synthetic cards, defaults to a temporary directory.")
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep the synthetic cards and outputs.")
+    parser.add_argument("--output", default="benchmark_results.json",
+                        help="Path to the JSON file the results are written to.")
+    parser.add_argument("--compare", default=None,
+                        help="Results of a previous benchmark to compare with.")
+    args = parser.parse_args()
+
+    workDir = args.workdir or tempfile.mkdtemp(prefix="ydcc_bench_")
+    if not os.path.isdir(workDir):
+        os.makedirs(workDir)
+
+    # One template per resolution, the second one is used for trips which
+    # change resolution halfway through.
+    width, height = [int(x) for x in args.resolution.split("x")]
+    templates = [os.path.join(workDir, "template_a.mp4"),
+                 os.path.join(workDir, "template_b.mp4")]
+    makeTemplate(templates[0], "%ix%i" % (width, height),
+                 args.segment_duration, args.fps)
+    makeTemplate(templates[1], "%ix%i" % (width * 3 // 8 * 2, height * 3 // 8 * 2),
+                 args.segment_duration, args.fps)
+    photo = os.path.join(workDir, "template.jpg")
+    makePhoto(photo)
+
+    results = []
+    for size in [int(n) for n in args.sizes.split(",")]:
+        results.extend(runSize(workDir, size, templates, photo, args))
+
+    with open(args.output, 'w') as f:
+        json.dump({"environment": getEnvironment(), "results": results}, f, indent=2)
+    print("\nResults written to %s" % args.output)
+
+    if args.compare:
+        compareResults(results, args.compare)
+
+    if not args.workdir and not args.keep:
+        rmtree(workDir)
+
+
+if __name__ == "__main__":
+    main()